@@ -20,46 +20,85 @@
 # OpenAI
 # 
 
-# In[1]:
+# In[ ]:
 
 
 # General Example: 
+import math
+from operator import attrgetter
+
+def dimension(name):
+    # a tracked attribute: setting it marks the shape's area as out of date
+    private = "_" + name
+
+    def set_dimension(shape, value):
+        setattr(shape, private, value)
+        shape._area_dirty = True
+    return property(attrgetter(private), set_dimension)
+
+class Shape:
+    # class-level defaults, so subclasses that skip Shape.__init__ start out dirty
+    _area = None
+    _area_dirty = True
 
-class Shape: 
     def __init__(self, area):
-        self.area = area
-    
+        self._area = area
+        self._area_dirty = False
+
+    # the area is only recomputed when it is read after a dimension changed
+    @property
+    def area(self):
+        if self._area_dirty:
+            self._area = self.compute_area()
+            self._area_dirty = False
+        return self._area
+
+    # subclasses that still assign self.area themselves (e.g. in update_area) keep working
+    @area.setter
+    def area(self, value):
+        self._area = value
+        self._area_dirty = False
+
     def update_area(self):
+        # nothing to do: setting a dimension already marks the area dirty, and the next
+        # read of area recomputes it. Kept so existing callers still work.
         pass
 
+    def compute_area(self):
+        return self._area
+
 class Square(Shape):
+    side = dimension("side")
+
     def __init__(self,side):
-        self.side = side 
-        self.update_area()
+        self.side = side
         self.name = "Square"
-    
-    def update_area(self):
-        self.area = self.side * self.side
+
+    def compute_area(self):
+        return self.side * self.side
 
 class Rectangle(Shape):
+    side1 = dimension("side1")
+    side2 = dimension("side2")
+
     def __init__(self,side1,side2):
         self.side1 = side1
         self.side2 = side2
-        self.update_area()
         self.name = "Rectangle"
-    
-    def update_area(self):
-        self.area = self.side1 * self.side2
-    
+
+    def compute_area(self):
+        return self.side1 * self.side2
+
 
 class Circle(Shape):
+    radius = dimension("radius")
+
     def __init__(self,radius):
         self.radius = radius
-        self.update_area()
         self.name = "Circle"
-    
-    def update_area(self):
-        self.area = self.radius**2 * 3.14
+
+    def compute_area(self):
+        return self.radius**2 * math.pi
 
 shapes = []
 shapes.append(Square(4))
@@ -70,6 +109,186 @@ for shape in shapes:
     shape.update_area()
     print(f"Area of {shape.name}:",shape.area)
 
+shapes[1].side2 = 10 # the next read of area recomputes it
+print(f"Area of {shapes[1].name}:",shapes[1].area)
+
+
+# In[ ]:
+
+
+# Columnar shape table
+# Millions of Shape objects cost ~150 bytes each, and updating them means one method call per
+# shape. ShapeTable stores the same shapes as three columns: a kind code (array of bytes) and
+# two dimensions (arrays of doubles). Squares and circles store their side/radius in both
+# dimension columns, so areas() needs one pass over all rows (dim1 * dim2, done by map() in C)
+# and one more over the circles only (times pi), with no per-shape method calls.
+from array import array
+from operator import mul
+
+class ShapeTable:
+    SQUARE, RECTANGLE, CIRCLE = range(3)
+
+    def __init__(self):
+        self.kinds = array('B')
+        self.dim1 = array('d')
+        self.dim2 = array('d')
+        self._circle_rows = array('q')
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def add_square(self, side):
+        self._append(self.SQUARE, side, side)
+
+    def add_rectangle(self, side1, side2):
+        self._append(self.RECTANGLE, side1, side2)
+
+    def add_circle(self, radius):
+        self._append(self.CIRCLE, radius, radius)
+
+    def _append(self, kind, dim1, dim2):
+        if kind == self.CIRCLE:
+            self._circle_rows.append(len(self.kinds))
+        self.kinds.append(kind)
+        self.dim1.append(dim1)
+        self.dim2.append(dim2)
+
+    def add_shape(self, shape):
+        if isinstance(shape, Square):
+            self.add_square(shape.side)
+        elif isinstance(shape, Rectangle):
+            self.add_rectangle(shape.side1, shape.side2)
+        elif isinstance(shape, Circle):
+            self.add_circle(shape.radius)
+        else:
+            raise ValueError(f"Unsupported shape: {type(shape).__name__}")
+
+    @classmethod
+    def from_shapes(cls, shapes):
+        table = cls()
+        for shape in shapes:
+            table.add_shape(shape)
+        return table
+
+    def shape(self, i):
+        kind, dim1, dim2 = self.kinds[i], self.dim1[i], self.dim2[i]
+        if kind == self.SQUARE:
+            return Square(dim1)
+        if kind == self.RECTANGLE:
+            return Rectangle(dim1, dim2)
+        return Circle(dim1)
+
+    def to_shapes(self):
+        return [self.shape(i) for i in range(len(self))]
+
+    def areas(self):
+        areas = list(map(mul, self.dim1, self.dim2))
+        pi = math.pi
+        for i in self._circle_rows:
+            areas[i] *= pi
+        return array('d', areas)
+
+    def total_area(self, kind=None):
+        areas = self.areas()
+        if kind is None:
+            return math.fsum(areas)
+        return math.fsum(area for area, k in zip(areas, self.kinds) if k == kind)
+
+
+table = ShapeTable.from_shapes(shapes)
+table.add_circle(1)
+print(list(table.areas()))  # [16.0, 20.0, 28.274333882308138, 3.141592653589793]
+print([(shape.name, shape.area) for shape in table.to_shapes()])
+print(table.total_area(ShapeTable.CIRCLE))
+
+
+# In[ ]:
+
+
+# Benchmark: areas of 1M mixed shapes, as objects (reading each new shape's area) vs.
+# ShapeTable.areas()
+import random
+import sys
+import time
+
+def shape_benchmark(n=1_000_000):
+    rng = random.Random(0)
+    table = ShapeTable()
+    for _ in range(n):
+        kind = rng.randrange(3)
+        if kind == ShapeTable.RECTANGLE:
+            table.add_rectangle(rng.uniform(1, 10), rng.uniform(1, 10))
+        else:
+            table._append(kind, *[rng.uniform(1, 10)] * 2)
+    objects = table.to_shapes()
+
+    start = time.perf_counter()
+    for shape in objects:
+        shape.area
+    object_time = time.perf_counter() - start
+    start = time.perf_counter()
+    areas = table.areas()
+    table_time = time.perf_counter() - start
+    assert all(math.isclose(shape.area, area) for shape, area in zip(objects, areas))
+    print(f"objects:    {object_time:.3f} s")
+    print(f"ShapeTable: {table_time:.3f} s ({object_time / table_time:.1f}x faster)")
+    object_bytes = sum(sys.getsizeof(shape) + sys.getsizeof(shape.__dict__) for shape in objects[:1000]) / 1000
+    table_bytes = sum(column.itemsize for column in (table.kinds, table.dim1, table.dim2))
+    print(f"memory per shape: ~{object_bytes:.0f} bytes as an object, {table_bytes} bytes in the table")
+
+shape_benchmark()
+
+
+# In[ ]:
+
+
+# Benchmark: a mutation-heavy workload (1M dimension changes on 10,000 rectangles, the caller
+# calling update_area() after each change, the area read once every 10 changes) with eager
+# areas, as in the original classes, vs. the dirty flag above
+import random
+import time
+
+class EagerRectangle:
+    computations = 0
+
+    def __init__(self, side1, side2):
+        self.side1 = side1
+        self.side2 = side2
+        self.update_area()
+
+    def update_area(self):
+        EagerRectangle.computations += 1
+        self.area = self.side1 * self.side2
+
+class CountingRectangle(Rectangle):
+    computations = 0
+
+    def compute_area(self):
+        CountingRectangle.computations += 1
+        return super().compute_area()
+
+def dirty_flag_benchmark(n_shapes=10_000, n_changes=1_000_000, read_every=10):
+    rng = random.Random(0)
+    changes = [(rng.randrange(n_shapes), rng.random() < 0.5, rng.uniform(1, 10)) for _ in range(n_changes)]
+    for cls in (EagerRectangle, CountingRectangle):
+        rects = [cls(1.0, 1.0) for _ in range(n_shapes)]
+        cls.computations = 0
+        total = 0.0
+        start = time.perf_counter()
+        for step, (i, first, value) in enumerate(changes):
+            rect = rects[i]
+            if first:
+                rect.side1 = value
+            else:
+                rect.side2 = value
+            rect.update_area()
+            if step % read_every == 0:
+                total += rect.area
+        elapsed = time.perf_counter() - start
+        print(f"{cls.__name__:18s} {elapsed:.3f} s   area computations: {cls.computations:,}   total {total:.1f}")
+
+dirty_flag_benchmark()
+
 
 # ## Attributes & Objects
 # 
@@ -758,7 +977,34 @@ print(user1.__password)
 # In[ ]:
 
 
+# Email access auditing is opt-in and sampled: with no hook installed, reading an email costs one
+# extra global lookup. enable_email_audit(hook, sample_rate) calls hook(user, timestamp) for
+# roughly sample_rate of the reads (1.0 audits every read).
+import random
 from datetime import datetime
+
+_email_audit = None  # (hook, sample_rate) while auditing is enabled
+
+def enable_email_audit(hook, sample_rate=0.01):
+    global _email_audit
+    if not 0 < sample_rate <= 1:
+        raise ValueError("sample_rate must be in (0, 1]")
+    _email_audit = (hook, sample_rate)
+
+def disable_email_audit():
+    global _email_audit
+    _email_audit = None
+
+def _audit_email_access(user, audit):
+    # audit is the (hook, sample_rate) the caller read from _email_audit: reading the global
+    # only once means a concurrent disable_email_audit() can't slip in between
+    hook, sample_rate = audit
+    if sample_rate == 1 or random.random() < sample_rate:
+        hook(user, datetime.now())
+
+def print_email_access(user, timestamp):
+    print(f"Email of {user.username} accessed at {timestamp}")
+
 class User: 
     def __init__(self,username, email, password):
         self.username = username
@@ -766,7 +1012,9 @@ class User:
         self.password = password 
 
     def get_email(self):
-        print(f"Email accessed at {datetime.now()}")
+        audit = _email_audit
+        if audit is not None:
+            _audit_email_access(self, audit)
         return self.email
     
     def set_email(self,new_email):
@@ -779,6 +1027,10 @@ user1.set_email("danny@outlook.com")
 
 print(user1.get_email())
 
+enable_email_audit(print_email_access, sample_rate=1.0)
+print(user1.get_email())
+disable_email_audit()
+
 
 # In[ ]:
 
@@ -794,7 +1046,9 @@ class User:
     # creating as get property
     @property 
     def email(self):
-        print(f"Email accessed")
+        audit = _email_audit  # read once, see _audit_email_access
+        if audit is not None: # opt-in, sampled audit (see enable_email_audit above)
+            _audit_email_access(self, audit)
         return self._email
     
     # set property to update email
@@ -810,6 +1064,519 @@ print(user1.email)
 # In[ ]:
 
 
+# Microbenchmark: cost of one email read. The old property printed on every read (timed here
+# with output sent to os.devnull, so terminal speed is left out).
+import os
+import timeit
+
+class PrintingUser(User):
+    @property
+    def email(self):
+        print("Email accessed", file=devnull)
+        return self._email
+
+class PlainUser:
+    def __init__(self, email):
+        self.email = email
+
+def email_read_benchmark(n=1_000_000):
+    cases = {
+        "plain attribute": PlainUser("hamed98@gmail.com"),
+        "property, audit off": User("Hamed", "hamed98@gmail.com", "1234"),
+        "property, print": PrintingUser("Hamed", "hamed98@gmail.com", "1234"),
+    }
+    for name, user in cases.items():
+        seconds = min(timeit.repeat(lambda: user.email, number=n, repeat=3))
+        print(f"{name:24s} {seconds / n * 1e9:8.1f} ns/read")
+    enable_email_audit(lambda user, timestamp: None, sample_rate=0.01)
+    try:
+        user = cases["property, audit off"]
+        seconds = min(timeit.repeat(lambda: user.email, number=n, repeat=3))
+        print(f"{'property, audit 1%':24s} {seconds / n * 1e9:8.1f} ns/read")
+    finally:
+        disable_email_audit()
+
+with open(os.devnull, "w") as devnull:
+    email_read_benchmark()
+
+
+# In[ ]:
+
+
+# User registry
+# Looking a user up in a list means scanning every user. UserRegistry keeps hash indexes
+# (dicts) on username and on the normalized email, plus a sorted list of lowercase usernames
+# for autocomplete: a prefix search is a binary search for the first match followed by a
+# short forward walk. A user added to a registry tells it when its email changes, so the
+# email index never points at an old address.
+from bisect import bisect_left, insort
+
+def normalize_email(email):
+    return email.lower().strip()  # the clean_email rule
+
+class User:
+    __slots__ = ("username", "_email", "password", "_registry")
+
+    def __init__(self, username, email, password):
+        self.username = username
+        self._email = email
+        self.password = password
+        self._registry = None
+
+    @property
+    def email(self):
+        return self._email
+
+    @email.setter
+    def email(self, new_email):
+        if "@" in new_email:
+            if self._registry is not None:
+                self._registry._reindex_email(self, new_email)  # raises if the address is taken
+            self._email = new_email
+
+    def clean_email(self):
+        return normalize_email(self._email)
+
+    def say_hi_to_user(self, user):
+        print(f"Sending message to {user.username}: Hi {user.username}, it's {self.username}")
+
+class UserRegistry:
+    def __init__(self, users=()):
+        self._by_username = {}
+        self._by_email = {}
+        self._prefix_index = []  # sorted (username.lower(), username) pairs
+        self.add_many(users)
+
+    def __len__(self):
+        return len(self._by_username)
+
+    def __contains__(self, username):
+        return username in self._by_username
+
+    def _check_new(self, user):
+        if user._registry is not None:
+            raise ValueError(f"User {user.username!r} already belongs to a registry")
+        if user.username in self._by_username:
+            raise ValueError(f"Username {user.username!r} is already taken")
+        if user.clean_email() in self._by_email:
+            raise ValueError(f"Email {user.email!r} is already registered")
+
+    def _index(self, user):
+        self._by_username[user.username] = user
+        self._by_email[user.clean_email()] = user
+        user._registry = self
+
+    def add(self, user):
+        self._check_new(user)
+        self._index(user)
+        insort(self._prefix_index, (user.username.lower(), user.username))
+
+    def add_many(self, users):
+        # bulk load, all or nothing: the whole batch is checked (also against itself) before
+        # any user is indexed, and the prefix index is sorted once at the end instead of once
+        # per user
+        users = list(users)
+        usernames, emails, keys = set(), set(), []
+        for user in users:
+            self._check_new(user)
+            if user.username in usernames:
+                raise ValueError(f"Username {user.username!r} is already taken")
+            email = user.clean_email()
+            if email in emails:
+                raise ValueError(f"Email {user.email!r} is already registered")
+            usernames.add(user.username)
+            emails.add(email)
+            keys.append((user.username.lower(), user.username))
+        for user in users:
+            self._index(user)
+        self._prefix_index.extend(keys)
+        self._prefix_index.sort()
+
+    def remove(self, username):
+        user = self._by_username.pop(username)
+        del self._by_email[user.clean_email()]
+        key = (username.lower(), username)
+        del self._prefix_index[bisect_left(self._prefix_index, key)]
+        user._registry = None
+        return user
+
+    def _reindex_email(self, user, new_email):
+        old_key, new_key = user.clean_email(), normalize_email(new_email)
+        if new_key == old_key:
+            return
+        if new_key in self._by_email:
+            raise ValueError(f"Email {new_email!r} is already registered")
+        del self._by_email[old_key]
+        self._by_email[new_key] = user
+
+    def get_by_username(self, username):
+        return self._by_username.get(username)
+
+    def get_by_email(self, email):
+        return self._by_email.get(normalize_email(email))
+
+    def autocomplete(self, prefix, limit=10):
+        prefix = prefix.lower()
+        index = self._prefix_index
+        start = bisect_left(index, (prefix,))
+        # a slice of at most `limit` entries, never a copy of the rest of the list
+        return [username for key, username in index[start:start + limit] if key.startswith(prefix)]
+
+
+registry = UserRegistry([User("Hamed", "HameD98@gmail.com", "1234"), User("Batman", "bat@outlook.com", "abc")])
+registry.add(User("Batgirl", "batgirl@outlook.com", "xyz"))
+
+user1 = registry.get_by_username("Hamed")
+user1.say_hi_to_user(registry.get_by_email("  BAT@outlook.com"))
+print(registry.autocomplete("bat"))  # ['Batgirl', 'Batman']
+
+user1.email = "hamed@outlook.com"  # the email index follows the setter
+print(registry.get_by_email("hamed98@gmail.com"), registry.get_by_email("hamed@outlook.com").username)
+
+
+# In[ ]:
+
+
+# Registry benchmark: 200k users, lookups by a linear scan over a list vs. the registry's indexes
+import random
+import time
+
+def registry_benchmark(n_users=200_000, n_lookups=50):
+    users = [User(f"user{i:07d}", f"User{i}@Example.com", "secret") for i in range(n_users)]
+    start = time.perf_counter()
+    registry = UserRegistry(users)
+    print(f"built the registry in {time.perf_counter() - start:.2f} s")
+
+    rng = random.Random(0)
+    emails = [f"user{rng.randrange(n_users)}@example.com" for _ in range(n_lookups)]
+    start = time.perf_counter()
+    for email in emails:
+        next(user for user in users if user.clean_email() == email)
+    scan = (time.perf_counter() - start) / n_lookups
+    start = time.perf_counter()
+    for email in emails:
+        registry.get_by_email(email)
+    indexed = (time.perf_counter() - start) / n_lookups
+    print(f"lookup by email: scan {scan * 1e3:.1f} ms, index {indexed * 1e6:.2f} us")
+
+    start = time.perf_counter()
+    for i in range(n_lookups):
+        registry.autocomplete(f"user{i:04d}")
+    print(f"autocomplete: {(time.perf_counter() - start) / n_lookups * 1e6:.1f} us per prefix")
+
+registry_benchmark()
+
+
+# In[ ]:
+
+
+# Streaming bulk import
+# UserImporter reads a CSV (header: username,email,password) or JSONL file one row at a time and
+# yields lists of at most chunk_size users, so memory stays bounded by one chunk however large
+# the file is. Rows are checked the way the email setter checks ("@" in the address) and emails
+# are stored normalized (the clean_email rule). Rows that fail are counted in the report,
+# which keeps the first max_rejects_kept of them (line number, reason) as examples.
+import csv
+import json
+import time
+
+class UserImporter:
+    FIELDS = ("username", "email", "password")
+
+    def __init__(self, path, chunk_size=10_000, max_rejects_kept=100):
+        if path.endswith(".csv"):
+            self._format = "csv"
+        elif path.endswith(".jsonl"):
+            self._format = "jsonl"
+        else:
+            raise ValueError(f"Unsupported file type: {path!r} (expected .csv or .jsonl)")
+        self._path = path
+        self._chunk_size = chunk_size
+        self._max_rejects_kept = max_rejects_kept
+        self.report = {"rows": 0, "accepted": 0, "rejected": 0, "rejects": [],
+                       "seconds": 0.0, "rows_per_second": 0.0}
+
+    def _rows(self, file):
+        # yields (line_number, (username, email, password)), or (line_number, None) for a row
+        # that can't be parsed
+        if self._format == "csv":
+            reader = csv.reader(file)
+            header = next(reader, [])
+            missing = [field for field in self.FIELDS if field not in header]
+            if missing:
+                raise ValueError(f"CSV header is missing {', '.join(missing)}")
+            columns = [header.index(field) for field in self.FIELDS]
+            width = max(columns) + 1
+            for row in reader:
+                if not row:
+                    continue  # a blank line, skipped like in JSONL
+                yield reader.line_num, tuple(row[i] for i in columns) if len(row) >= width else None
+        else:
+            for line_number, line in enumerate(file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = None
+                if isinstance(row, dict):
+                    yield line_number, (row.get("username"), row.get("email"), row.get("password"))
+                else:
+                    yield line_number, None
+
+    def _reject(self, line_number, reason):
+        self.report["rejected"] += 1
+        if len(self.report["rejects"]) < self._max_rejects_kept:
+            self.report["rejects"].append((line_number, reason))
+
+    def __iter__(self):
+        report = self.report
+        start = time.perf_counter()
+        chunk = []
+        try:
+            with open(self._path, newline="", encoding="utf-8") as file:
+                for line_number, row in self._rows(file):
+                    report["rows"] += 1
+                    if row is None:
+                        self._reject(line_number, "malformed row")
+                        continue
+                    username, email, password = row
+                    if not (username and email and password):
+                        self._reject(line_number, "missing field")
+                    elif not (type(username) is str and type(email) is str and type(password) is str):
+                        self._reject(line_number, "malformed row")  # e.g. a number in JSONL
+                    elif "@" not in email:
+                        self._reject(line_number, f"invalid email {email!r}")
+                    else:
+                        chunk.append(User(username, normalize_email(email), password))
+                        if len(chunk) == self._chunk_size:
+                            report["accepted"] += len(chunk)
+                            yield chunk
+                            chunk = []
+                if chunk:
+                    report["accepted"] += len(chunk)
+                    yield chunk
+        finally:
+            report["seconds"] = time.perf_counter() - start
+            report["rows_per_second"] = report["rows"] / report["seconds"] if report["seconds"] else 0.0
+
+
+import os
+import tempfile
+
+with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, "users.csv")
+    with open(path, "w", newline="") as file:
+        file.write("username,email,password\n"
+                   "Hamed, HameD98@gmail.com ,1234\n"
+                   "Batman,bat.outlook.com,abc\n"
+                   "Robin,,xyz\n"
+                   "Batgirl,batgirl@outlook.com,xyz\n")
+    importer = UserImporter(path)
+    imported = UserRegistry()
+    for chunk in importer:
+        imported.add_many(chunk)
+    print(imported.autocomplete(""))  # ['Batgirl', 'Hamed']
+    print(importer.report["accepted"], importer.report["rejected"], importer.report["rejects"])
+
+
+# In[ ]:
+
+
+# Import benchmark: 1M rows (1% with a bad email) from CSV and from JSONL, with the
+# peak memory of the import itself for two chunk sizes on a 200k-row file
+import tracemalloc
+
+def import_benchmark(n_rows=1_000_000):
+    with tempfile.TemporaryDirectory() as directory:
+        for extension in ("csv", "jsonl"):
+            path = os.path.join(directory, f"users.{extension}")
+            with open(path, "w", newline="") as file:
+                if extension == "csv":
+                    file.write("username,email,password\n")
+                for i in range(n_rows):
+                    email = f"User{i}@Example.com" if i % 100 else f"user{i}.example.com"
+                    if extension == "csv":
+                        file.write(f"user{i},{email},secret\n")
+                    else:
+                        file.write(json.dumps({"username": f"user{i}", "email": email, "password": "secret"}) + "\n")
+            importer = UserImporter(path)
+            for chunk in importer:
+                pass  # the report's time includes whatever the loop body does with each chunk
+            report = importer.report
+            print(f"{extension:5s} {report['rows_per_second']:10,.0f} rows/s   accepted {report['accepted']:,}"
+                  f"   rejected {report['rejected']:,}")
+
+        path = os.path.join(directory, "users.csv")
+        with open(path, "w") as file:
+            file.write("username,email,password\n")
+            file.writelines(f"user{i},user{i}@example.com,secret\n" for i in range(200_000))
+        for chunk_size in (1_000, 100_000):
+            tracemalloc.start()
+            for chunk in UserImporter(path, chunk_size=chunk_size):
+                pass  # e.g. write the chunk to a database
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"chunk_size {chunk_size:7,d}: peak {peak / 2**20:6.1f} MiB")
+
+import_benchmark()
+
+
+# In[ ]:
+
+
+get_ipython().run_cell_magic('writefile', 'passwords.py', '\nimport asyncio\nimport base64\nimport hashlib\nimport hmac\nimport os\nimport secrets\nimport threading\nimport time\nfrom collections import OrderedDict\nfrom concurrent.futures import ProcessPoolExecutor\n\n# ===== Password hashes =====\n# Encoded as "scrypt$n$r$p$salt$hash" or "pbkdf2_sha256$iterations$salt$hash" (base64 salt and hash),\n# so a hash carries the parameters it was made with and old hashes stay valid when defaults change.\n\nSCRYPT_PARAMS = {"n": 2 ** 14, "r": 8, "p": 1}\nPBKDF2_ITERATIONS = 600_000\n\ndef _b64(raw):\n    return base64.b64encode(raw).decode("ascii")\n\ndef hash_password(password, algorithm="scrypt", salt=None, **params):\n    salt = salt or os.urandom(16)\n    if algorithm == "scrypt":\n        params = {**SCRYPT_PARAMS, **params}\n        n, r, p = params["n"], params["r"], params["p"]\n        digest = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,\n                                maxmem=256 * n * r + 2 ** 20, dklen=32)\n        return f"scrypt${n}${r}${p}${_b64(salt)}${_b64(digest)}"\n    if algorithm == "pbkdf2_sha256":\n        iterations = params.get("iterations", PBKDF2_ITERATIONS)\n        digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)\n        return f"pbkdf2_sha256${iterations}${_b64(salt)}${_b64(digest)}"\n    raise ValueError(f"Unknown password hashing algorithm: {algorithm!r}")\n\ndef verify_password(password, encoded):\n    algorithm, *fields = encoded.split("$")\n    if algorithm == "scrypt" and len(fields) == 5:\n        n, r, p, salt, digest = fields\n        params = {"n": int(n), "r": int(r), "p": int(p)}\n    elif algorithm == "pbkdf2_sha256" and len(fields) == 3:\n        iterations, salt, digest = fields\n        params = {"iterations": int(iterations)}\n    else:\n        raise ValueError("Malformed password hash")\n    candidate = hash_password(password, algorithm, base64.b64decode(salt), **params)\n    return hmac.compare_digest(candidate.rsplit("$", 1)[1], digest)\n\ndef _hash_task(task):\n    # runs in a worker process\n    password, algorithm, params = task\n    return hash_password(password, algorithm, **params)\n\ndef _verify_task(task):\n    return verify_password(*task)\n\n# ===== Verification cache =====\n\nclass TTLCache:\n    # at most maxsize entries, each valid for ttl seconds; the least recently used goes first\n    def __init__(self, maxsize=10_000, ttl=300.0, clock=time.monotonic):\n        if maxsize < 1 or ttl <= 0:\n            raise ValueError("maxsize and ttl must be positive")\n        self._maxsize = maxsize\n        self._ttl = ttl\n        self._clock = clock\n        self._entries = OrderedDict()  # key -> (expires_at, value)\n        self._lock = threading.Lock()\n\n    def __len__(self):\n        return len(self._entries)\n\n    def get(self, key, default=None):\n        with self._lock:\n            entry = self._entries.get(key)\n            if entry is None:\n                return default\n            if entry[0] <= self._clock():\n                del self._entries[key]\n                return default\n            self._entries.move_to_end(key)\n            return entry[1]\n\n    def set(self, key, value):\n        with self._lock:\n            self._entries[key] = (self._clock() + self._ttl, value)\n            self._entries.move_to_end(key)\n            if len(self._entries) > self._maxsize:\n                self._entries.popitem(last=False)\n\n# ===== Hasher =====\n\nclass PasswordHasher:\n    # KDF work runs in a process pool (the KDFs hold the GIL for part of their run, and a pool\n    # keeps a busy event loop responsive). Verification results are cached under a keyed digest\n    # of (password, hash), so the cache never holds a plaintext password.\n    def __init__(self, algorithm="scrypt", workers=None, cache_size=10_000, cache_ttl=300.0,\n                 executor=None, **params):\n        if algorithm not in ("scrypt", "pbkdf2_sha256"):\n            raise ValueError(f"Unknown password hashing algorithm: {algorithm!r}")\n        self._algorithm = algorithm\n        self._params = params\n        self._executor = executor or ProcessPoolExecutor(max_workers=workers)\n        self._owns_executor = executor is None\n        self._cache = TTLCache(cache_size, cache_ttl)\n        self._cache_key = secrets.token_bytes(32)\n        self._in_flight = {}  # key -> future of a verification already running (async API)\n        self.stats = {"hits": 0, "misses": 0}\n\n    def _key(self, password, encoded):\n        return hmac.digest(self._cache_key, f"{encoded}\\0{password}".encode(), "sha256")\n\n    def _cached(self, key):\n        result = self._cache.get(key)\n        self.stats["hits" if result is not None else "misses"] += 1\n        return result\n\n    def hash(self, password):\n        return self._executor.submit(_hash_task, (password, self._algorithm, self._params)).result()\n\n    def hash_many(self, passwords, chunksize=16):\n        tasks = ((password, self._algorithm, self._params) for password in passwords)\n        return list(self._executor.map(_hash_task, tasks, chunksize=chunksize))\n\n    def verify(self, password, encoded):\n        key = self._key(password, encoded)\n        result = self._cached(key)\n        if result is None:\n            result = self._executor.submit(_verify_task, (password, encoded)).result()\n            self._cache.set(key, result)\n        return result\n\n    def verify_many(self, pairs, chunksize=16):\n        pairs = list(pairs)\n        keys = [self._key(password, encoded) for password, encoded in pairs]\n        results = [self._cached(key) for key in keys]\n        missing = [i for i, result in enumerate(results) if result is None]\n        computed = self._executor.map(_verify_task, [pairs[i] for i in missing], chunksize=chunksize)\n        for i, result in zip(missing, computed):\n            results[i] = result\n            self._cache.set(keys[i], result)\n        return results\n\n    async def hash_async(self, password):\n        loop = asyncio.get_running_loop()\n        return await loop.run_in_executor(self._executor, _hash_task, (password, self._algorithm, self._params))\n\n    async def verify_async(self, password, encoded):\n        key = self._key(password, encoded)\n        result = self._cached(key)\n        if result is not None:\n            return result\n        # concurrent logins with the same credentials share one verification\n        future = self._in_flight.get(key)\n        if future is None:\n            loop = asyncio.get_running_loop()\n            future = loop.run_in_executor(self._executor, _verify_task, (password, encoded))\n            self._in_flight[key] = future\n            future.add_done_callback(lambda _: self._in_flight.pop(key, None))\n        result = await asyncio.shield(future)\n        self._cache.set(key, result)\n        return result\n\n    def close(self):\n        if self._owns_executor:\n            self._executor.shutdown()\n\n    def __enter__(self):\n        return self\n\n    def __exit__(self, *exc_info):\n        self.close()\n\nif __name__ == "__main__":\n    with PasswordHasher() as hasher:\n        start = time.perf_counter()\n        hashes = hasher.hash_many(f"password{i}" for i in range(64))\n        print(f"hashed 64 passwords in {time.perf_counter() - start:.2f} s")\n        print(hasher.verify_many([("password0", hashes[0]), ("wrong", hashes[1])]))\n')
+
+
+# In[ ]:
+
+
+# Hashed passwords
+# Instead of the plaintext password, users store a salted scrypt hash (see passwords.py).
+# Hashing is deliberately slow (~50-100 ms), so UserAuthenticator hashes whole batches in the
+# hasher's process pool, and logins are checked through its TTL cache: repeated logins with
+# the same credentials cost one dictionary lookup instead of another KDF run.
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from passwords import PasswordHasher
+
+def run_async(coro):
+    # runs a coroutine to completion from plain Python and from a notebook, whose own
+    # event loop is already running, by giving it a fresh loop in a helper thread
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+class UserAuthenticator:
+    def __init__(self, registry, hasher):
+        self._registry = registry
+        self._hasher = hasher
+
+    def register_many(self, users):
+        # users arrive with plaintext passwords (e.g. a UserImporter chunk)
+        for user, encoded in zip(users, self._hasher.hash_many(user.password for user in users)):
+            user.password = encoded
+        self._registry.add_many(users)
+
+    def login(self, username, password):
+        user = self._registry.get_by_username(username)
+        return user is not None and self._hasher.verify(password, user.password)
+
+    async def login_async(self, username, password):
+        user = self._registry.get_by_username(username)
+        return user is not None and await self._hasher.verify_async(password, user.password)
+
+
+with PasswordHasher() as hasher:
+    auth = UserAuthenticator(UserRegistry(), hasher)
+    auth.register_many([User("Hamed", "hamed98@gmail.com", "1234"), User("Batman", "bat@outlook.com", "abc")])
+    print(auth._registry.get_by_username("Hamed").password[:20], "...")
+    print(auth.login("Hamed", "1234"), auth.login("Hamed", "4321"), auth.login("Robin", "1234"))  # True False False
+    print(run_async(auth.login_async("Batman", "abc")))  # True
+
+
+# In[ ]:
+
+
+# Benchmark: a login storm (20 users logging in again and again, 20 concurrent logins at a time)
+# with and without the verification cache, measuring how late a 10 ms ticker task on the same
+# event loop runs
+import asyncio
+import time
+
+async def login_storm(auth, n_logins, n_users):
+    lags = []
+
+    async def ticker():
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - start - 0.01)
+
+    ticking = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    ok = True
+    for _ in range(n_logins // n_users):
+        results = await asyncio.gather(*(auth.login_async(f"user{i}", "secret") for i in range(n_users)))
+        ok = ok and all(results)
+    elapsed = time.perf_counter() - start
+    ticking.cancel()
+    return ok, elapsed, max(lags, default=0.0)
+
+def password_benchmark(n_logins=200, n_users=20):
+    users = [User(f"user{i}", f"user{i}@example.com", "secret") for i in range(n_users)]
+    registry = UserRegistry()
+    with PasswordHasher() as hasher:
+        start = time.perf_counter()
+        UserAuthenticator(registry, hasher).register_many(users)
+        print(f"hashed {n_users} passwords in {time.perf_counter() - start:.2f} s")
+    for cache_size in (1, 10_000):  # a single slot: 20 users in rotation always miss
+        with PasswordHasher(cache_size=cache_size) as hasher:
+            ok, elapsed, lag = run_async(login_storm(UserAuthenticator(registry, hasher), n_logins, n_users))
+        print(f"cache size {cache_size:6,d}: {n_logins / elapsed:10,.0f} logins/s   all ok: {ok}"
+              f"   worst ticker lag {lag * 1e3:.1f} ms")
+
+password_benchmark()
+
+
+# In[ ]:
+
+
+# Sharded counters
+# `User.user_count += 1` reads the class attribute, adds one and writes it back. Two threads can
+# read the same value and one increment is lost, and every constructor updates the same shared
+# value. A ShardedCounter gives each thread its own shard to increment (only that thread writes
+# it, so no lock is needed) and adds the shards up when the value is read. Shards of threads that
+# have finished are folded into a single total so they don't pile up.
+# CounterAttribute exposes a counter as a read-only class attribute, on the class and on instances.
+import threading
+
+class ShardedCounter:
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()  # guards _shards and _retired, not increments
+        self._shards = []              # [count, thread] per live thread
+        self._retired = 0
+
+    def _new_shard(self):
+        shard = [0, threading.current_thread()]
+        with self._lock:
+            self._shards.append(shard)
+        self._local.shard = shard
+        return shard
+
+    def increment(self, amount=1):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._new_shard()
+        shard[0] += amount
+
+    @property
+    def value(self):
+        with self._lock:
+            live = []
+            for shard in self._shards:
+                if shard[1].is_alive():
+                    live.append(shard)
+                else:
+                    self._retired += shard[0]
+            self._shards = live
+            return self._retired + sum(shard[0] for shard in live)
+
+class CounterAttribute:
+    def __init__(self, counter):
+        self.counter = counter
+
+    def __get__(self, instance, owner=None):
+        return self.counter.value
+
+    def __set__(self, instance, value):
+        raise AttributeError("counter attributes are read-only; use counter.increment()")
+
+
+# In[ ]:
+
+
 # static attributes (shared among all instances of the class)
 # A static attribute (sometimes called a class attribte) is an attribute that belongs to the class itself, 
 # not to any specific instance of the class 
@@ -817,12 +1584,13 @@ print(user1.email)
 
 class User: 
 
-    user_count = 0 # initially zero 
+    _user_counter = ShardedCounter() # starts at zero; safe to increment from many threads
+    user_count = CounterAttribute(_user_counter)
 
     def __init__(self,username, email):
         self.username = username
         self.email = email 
-        User.user_count += 1
+        User._user_counter.increment()
     
     def display_user(self):
         print(f"Username:{self.username}, Email: {self.email}")
@@ -844,6 +1612,53 @@ user1.display_user()
 # In[ ]:
 
 
+# Benchmark: constructing users from N threads with a plain class attribute (`+= 1`), a
+# lock-protected counter and the sharded counter. The plain attribute can lose increments.
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class PlainCountUser:
+    user_count = 0
+
+    def __init__(self, username, email):
+        self.username = username
+        self.email = email
+        PlainCountUser.user_count += 1
+
+class LockedCountUser:
+    user_count = 0
+    _lock = threading.Lock()
+
+    def __init__(self, username, email):
+        self.username = username
+        self.email = email
+        with LockedCountUser._lock:
+            LockedCountUser.user_count += 1
+
+def counter_benchmark(n_users=1_000_000, thread_counts=(1, 4, 8)):
+    for n_threads in thread_counts:
+        for cls in (PlainCountUser, LockedCountUser, User):
+            before = cls.user_count
+            per_thread = n_users // n_threads
+
+            def construct(_):
+                for _ in range(per_thread):
+                    cls("user", "user@example.com")
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(n_threads) as executor:
+                list(executor.map(construct, range(n_threads)))
+            elapsed = time.perf_counter() - start
+            lost = per_thread * n_threads - (cls.user_count - before)
+            print(f"{n_threads} threads  {cls.__name__:16s} {per_thread * n_threads / elapsed:12,.0f} users/s"
+                  f"   lost increments: {lost}")
+
+counter_benchmark()
+
+
+# In[ ]:
+
+
 # Static vs. Instance Method Example 
 
 class BankAccount: 
@@ -871,19 +1686,131 @@ print(BankAccount.is_valid_interest_rate(3))
 
 
 
+# In[ ]:
+
+
+# Buffered transaction log
+# Printing every transaction makes each deposit wait for stdout. Instead, records are appended to
+# an in-memory buffer and a background thread hands them to a sink in batches: when the buffer
+# reaches max_batch records, or every flush_interval seconds, whichever comes first.
+# close() (also run at interpreter exit) writes whatever is still buffered.
+# If the sink raises, the batch goes back to the front of the buffer and the background thread
+# retries it on its next round, so a failing sink delays records but never drops them.
+import atexit
+import threading
+import time
+from collections import deque, namedtuple
+
+TransactionRecord = namedtuple("TransactionRecord", "timestamp owner transaction_type amount balance")
+
+class RingBufferSink:
+    # keeps only the most recent `capacity` records in memory
+    def __init__(self, capacity=10_000):
+        self.records = deque(maxlen=capacity)
+
+    def write(self, records):
+        self.records.extend(records)
+
+    def close(self):
+        pass
+
+class AppendOnlyFileSink:
+    # one tab-separated line per record, appended to the end of the file
+    def __init__(self, path):
+        self._file = open(path, "a", encoding="utf-8")
+
+    def write(self, records):
+        self._file.write("".join("\t".join(map(str, record)) + "\n" for record in records))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+class BufferedTransactionLog:
+    def __init__(self, sink, max_batch=1_000, flush_interval=0.5):
+        self._sink = sink
+        self._max_batch = max_batch
+        self._flush_interval = flush_interval
+        self._buffer = []
+        self._lock = threading.Lock()        # guards _buffer and _closed
+        self._write_lock = threading.Lock()  # keeps batches in order at the sink
+        self._wakeup = threading.Event()
+        self._closed = False
+        self.failed_writes = 0
+        self.last_error = None
+        self._thread = threading.Thread(target=self._run, name="transaction-log", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def log(self, owner, transaction_type, amount, balance):
+        record = TransactionRecord(time.time(), owner, transaction_type, amount, balance)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Transaction log is closed")
+            self._buffer.append(record)
+            if len(self._buffer) >= self._max_batch:
+                self._wakeup.set()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                pass  # the batch is back in the buffer; try again next round
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                batch, self._buffer = self._buffer, []
+            if batch:
+                try:
+                    self._sink.write(batch)
+                except Exception as error:
+                    with self._lock:
+                        self._buffer[:0] = batch
+                    self.failed_writes += 1
+                    self.last_error = error
+                    raise
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        try:
+            self.flush()  # anything logged before close() is written exactly once
+        finally:
+            self._sink.close()
+            atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+recent_transactions = RingBufferSink()
+default_transaction_log = BufferedTransactionLog(recent_transactions)
+
+
 # In[ ]:
 
 
 class BankAccount:
-    def __init(self,owner,balance = 0):
+    def __init__(self,owner,balance = 0,transaction_log = None):
         self.owner = owner
         self._balance = balance 
+        self._transaction_log = transaction_log or default_transaction_log
     
     def deposit(self,amount):
         if self._is_valid_amount(amount): 
             self._balance += amount 
             self.__log_transaction("deposit",amount)
-            print(f"{self.owner}'s new balance: ${self._balance}")
         else: 
             print("Invalid amount")
     
@@ -892,7 +1819,8 @@ class BankAccount:
 
     # creating private methods
     def __log_transaction(self,transaction_type,amount):
-        print(f"Logging {transaction_type} of ${amount}. New balance: ${self._balance}")
+        # hands the record to the buffered log instead of printing it on every call
+        self._transaction_log.log(self.owner,transaction_type,amount,self._balance)
 
     @staticmethod 
     def is_valid_interest_rate(rate):
@@ -903,10 +1831,10 @@ account = BankAccount("Hamed",1000)
 account.deposit(200)
 print(BankAccount.is_valid_interest_rate(3))
 
-account.__log_transaction("withdraw",200) # this will give an error since the method is private and can't be accessed outside the class
-
-
+default_transaction_log.flush()
+print(recent_transactions.records[-1])  # TransactionRecord(..., owner='Hamed', transaction_type='deposit', amount=200, balance=1200)
 
+account.__log_transaction("withdraw",200) # this will give an error since the method is private and can't be accessed outside the class
 
 
 
@@ -966,6 +1894,833 @@ print(account.balance)
         
 
 
+# In[ ]:
+
+
+# Batched ledger (columnar storage)
+# Instead of one BankAccount object (and one Python float) per account, all balances live in
+# one contiguous array indexed by account id, and transactions are stored column by column.
+# A whole batch is applied in a single pass with the same rules as BankAccount.deposit/withdraw:
+# amounts must be positive and a withdrawal may not exceed the balance.
+import math
+from array import array
+
+class TransactionBatch:
+    DEPOSIT = 0
+    WITHDRAW = 1
+    KINDS = {"deposit": DEPOSIT, "withdraw": WITHDRAW}
+
+    def __init__(self, typecode='d'):
+        self.accounts = array('q')       # account id per row
+        self.amounts = array(typecode)   # amount per row, same type as the ledger balances
+        self.kinds = array('b')          # DEPOSIT or WITHDRAW per row
+
+    @classmethod
+    def from_rows(cls, rows, typecode='d'):
+        # rows are (account_id, amount, kind) tuples with kind "deposit" or "withdraw"
+        batch = cls(typecode)
+        for account_id, amount, kind in rows:
+            batch.append(account_id, amount, kind)
+        return batch
+
+    def append(self, account_id, amount, kind):
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown transaction kind: {kind}")
+        self.accounts.append(account_id)
+        try:
+            self.amounts.append(amount)
+        except TypeError:
+            self.accounts.pop()  # keep the columns the same length
+            raise
+        self.kinds.append(self.KINDS[kind])
+
+    def __len__(self):
+        return len(self.accounts)
+
+
+class Ledger:
+    _typecode = 'd'  # storage type of the balance and amount columns
+
+    def __init__(self, n_accounts=0):
+        self._balances = array(self._typecode, [0]) * n_accounts
+
+    def open_account(self):
+        self._balances.append(0)
+        return len(self._balances) - 1  # the new account id
+
+    def __len__(self):
+        return len(self._balances)
+
+    def balance(self, account_id):
+        return self._balances[account_id]
+
+    def _amount(self, amount):
+        # checks an input amount and converts it to the type of the amount column
+        if not math.isfinite(amount):
+            raise ValueError(f"Amount must be finite: {amount}")
+        return amount
+
+    def _as_batch(self, rows, to_amount=None):
+        # returns (batch, rejected, source). Rows that cannot become a transaction (wrong number
+        # of fields, unknown kind, bad amount) are rejected here and left out of the batch;
+        # source then maps each batch row back to its input row (None when nothing was left out)
+        if isinstance(rows, TransactionBatch):
+            return rows, [], None
+        rows = rows if isinstance(rows, list) else list(rows)
+        batch = TransactionBatch(self._typecode)
+        # fast path: build each column in one pass; if any row is bad, redo it row by row.
+        # strict=True makes rows of different lengths fail instead of being cut short.
+        try:
+            account_ids, amounts, kinds = zip(*rows, strict=True) if rows else ((), (), ())
+            batch.accounts.extend(account_ids)
+            batch.amounts.extend(map(to_amount, amounts) if to_amount else amounts)
+            batch.kinds.extend(map(TransactionBatch.KINDS.__getitem__, kinds))
+            return batch, [], None
+        except (ValueError, TypeError, OverflowError, KeyError):
+            batch = TransactionBatch(self._typecode)
+        rejected = []
+        source = None
+        for row, fields in enumerate(rows):
+            try:
+                account_id, amount, kind = fields
+            except (ValueError, TypeError):
+                reason = "Row must be (account_id, amount, kind)"
+            else:
+                try:
+                    batch.append(account_id, to_amount(amount) if to_amount else amount, kind)
+                except (ValueError, TypeError, OverflowError) as error:
+                    reason = str(error)
+                else:
+                    if source is not None:
+                        source.append(row)
+                    continue
+            if source is None:
+                source = array('q', range(row))
+            rejected.append((row, reason))
+        return batch, rejected, source
+
+    def apply(self, rows):
+        # applies the rows in order and returns [(row, reason), ...] for the rejected ones;
+        # a rejected row leaves its account untouched
+        return self._apply_rows(rows, self._amount)
+
+    def _apply_rows(self, rows, to_amount):
+        batch, rejected, source = self._as_batch(rows, to_amount)
+        applied = self._apply_batch(batch)
+        if source is None:
+            return applied
+        return sorted(rejected + [(source[row], reason) for row, reason in applied])
+
+    def _apply_batch(self, batch):
+        # row numbers in the result are batch rows
+        balances = self._balances
+        n_accounts = len(balances)
+        deposit = TransactionBatch.DEPOSIT
+        rejected = []
+        reject = rejected.append
+        for row, (account_id, amount, kind) in enumerate(zip(batch.accounts, batch.amounts, batch.kinds)):
+            if not 0 <= account_id < n_accounts:
+                reject((row, "Unknown account"))
+            elif kind == deposit:
+                if amount <= 0:
+                    reject((row, "Deposite amount must be positive"))
+                else:
+                    balances[account_id] += amount
+            elif amount <= 0:
+                reject((row, "Withdraw amount must be positive"))
+            elif amount > balances[account_id]:
+                reject((row, "Insufficient funds"))
+            else:
+                balances[account_id] -= amount
+        return rejected
+
+
+ledger = Ledger(3)
+rejected = ledger.apply([
+    (0, 100, "deposit"),
+    (1, 50, "deposit"),
+    (0, 30, "withdraw"),
+    (1, 80, "withdraw"),   # Insufficient funds
+    (2, -5, "deposit"),    # amount must be positive
+    (7, 10, "deposit"),    # Unknown account
+    (1, 10, "refund"),     # Unknown transaction kind
+    (1, 10),               # Row must be (account_id, amount, kind)
+])
+print([ledger.balance(i) for i in range(len(ledger))])  # [70.0, 50.0, 0.0]
+print(rejected)
+
+
+# In[ ]:
+
+
+# Thread-safe accounts with lock striping
+# The encapsulated BankAccount checks `amount > self.balance` and then subtracts in two separate
+# steps, so two threads can both pass the check and overdraw the account.
+# Here every account id maps to one of a fixed number of locks ("stripes"): operations on accounts
+# in different stripes run in parallel, and the check and the update of a withdrawal happen under
+# the same lock, so they are atomic.
+import threading
+from array import array
+
+class ConcurrentAccountStore:
+    def __init__(self, n_accounts=0, n_stripes=64):
+        self._balances = array('d', [0]) * n_accounts
+        self._stripes = [threading.Lock() for _ in range(n_stripes)]
+        self._open_lock = threading.Lock()
+
+    def _check_account(self, account_id):
+        # negative ids would otherwise index from the end of the array
+        if not 0 <= account_id < len(self._balances):
+            raise ValueError("Unknown account")
+
+    def _lock_for(self, account_id):
+        self._check_account(account_id)
+        return self._stripes[account_id % len(self._stripes)]
+
+    def open_account(self, balance=0.0):
+        with self._open_lock:
+            self._balances.append(balance)
+            return len(self._balances) - 1
+
+    def balance(self, account_id):
+        with self._lock_for(account_id):
+            return self._balances[account_id]
+
+    def deposit(self, account_id, amount):
+        if amount <= 0:
+            raise ValueError("Deposite amount must be positive")
+        with self._lock_for(account_id):
+            self._balances[account_id] += amount
+
+    def withdraw(self, account_id, amount):
+        if amount <= 0:
+            raise ValueError("Withdraw amount must be positive")
+        with self._lock_for(account_id):
+            if amount > self._balances[account_id]:
+                raise ValueError("Insufficient funds")
+            self._balances[account_id] -= amount
+
+    def compare_and_withdraw(self, account_id, expected_balance, amount):
+        # withdraws only if nobody changed the balance since the caller read expected_balance
+        if amount <= 0:
+            raise ValueError("Withdraw amount must be positive")
+        with self._lock_for(account_id):
+            balance = self._balances[account_id]
+            if balance != expected_balance or amount > balance:
+                return False
+            self._balances[account_id] = balance - amount
+            return True
+
+    def transfer(self, from_id, to_id, amount):
+        if amount <= 0:
+            raise ValueError("Transfer amount must be positive")
+        self._check_account(from_id)
+        self._check_account(to_id)
+        # always lock stripes in index order so two opposite transfers cannot deadlock
+        locks = sorted({from_id % len(self._stripes), to_id % len(self._stripes)})
+        for index in locks:
+            self._stripes[index].acquire()
+        try:
+            if amount > self._balances[from_id]:
+                raise ValueError("Insufficient funds")
+            self._balances[from_id] -= amount
+            self._balances[to_id] += amount
+        finally:
+            for index in reversed(locks):
+                self._stripes[index].release()
+
+
+store = ConcurrentAccountStore()
+alice = store.open_account(100)
+bob = store.open_account()
+store.transfer(alice, bob, 40)
+print(store.balance(alice), store.balance(bob))  # 60.0 40.0
+print(store.compare_and_withdraw(alice, 60.0, 10))  # True
+print(store.compare_and_withdraw(alice, 60.0, 10))  # False, the balance is now 50.0
+try:
+    store.withdraw(-1, 10)
+except ValueError as error:
+    print(error)  # Unknown account
+
+
+# In[ ]:
+
+
+# Stress benchmark: throughput of ConcurrentAccountStore as the number of threads grows.
+# Every thread hammers random accounts with deposits and withdrawals; afterwards the money is
+# checked: nothing is lost, and no account went negative.
+import random
+import time
+
+def stress(n_threads, ops_per_thread=50_000, n_accounts=1_000, n_stripes=64):
+    store = ConcurrentAccountStore(n_accounts, n_stripes)
+    deposited = [0.0] * n_threads
+    withdrawn = [0.0] * n_threads
+
+    def worker(index):
+        rng = random.Random(index)
+        for _ in range(ops_per_thread):
+            account_id = rng.randrange(n_accounts)
+            amount = rng.randint(1, 100)
+            if rng.random() < 0.5:
+                store.deposit(account_id, amount)
+                deposited[index] += amount
+            else:
+                try:
+                    store.withdraw(account_id, amount)
+                    withdrawn[index] += amount
+                except ValueError:
+                    pass  # Insufficient funds
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n_threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    balances = [store.balance(i) for i in range(n_accounts)]
+    assert min(balances) >= 0, "an account was overdrawn"
+    assert sum(balances) == sum(deposited) - sum(withdrawn), "money was lost"
+    return n_threads * ops_per_thread / elapsed
+
+for n_threads in (1, 2, 4, 8, 16):
+    print(f"{n_threads:2d} threads: {stress(n_threads):12,.0f} ops/s")
+
+
+# In[ ]:
+
+
+# Write-ahead log (WAL) and snapshots
+# A Ledger only lives in memory. DurableLedger appends every accepted deposit/withdraw to a
+# binary WAL file (one fixed-size record each) before the call returns, and periodically writes
+# a snapshot of all balances as one raw array. Recovery loads the newest snapshot with a single
+# read and then replays only the WAL records written after it.
+#
+# Files in the directory:
+#   snapshot.bin  header (magic, typecode, accounts, WAL sequence) + raw balance array
+#   wal-<seq>.bin records (kind, account id, amount) appended after snapshot <seq>
+import os
+import struct
+
+class DurableLedger(Ledger):
+    OPEN = 2  # WAL kind for open_account; deposits and withdrawals use TransactionBatch kinds
+    _SNAPSHOT_HEADER = struct.Struct('<4scxxQQ')
+    _SNAPSHOT_MAGIC = b'LSNP'
+
+    def __init__(self, directory, snapshot_every=1_000_000, sync=False):
+        super().__init__()
+        self._directory = directory
+        self._snapshot_every = snapshot_every  # WAL records between automatic snapshots
+        self._sync = sync                      # fsync the WAL before returning
+        self._record = struct.Struct('<bq' + self._typecode)
+        os.makedirs(directory, exist_ok=True)
+        self._sequence, self._wal_records = self._recover()
+        self._wal = self._open_wal(self._sequence)
+        self.snapshot_error = None  # why the last automatic snapshot failed, if it did
+
+    def _open_wal(self, sequence):
+        # unbuffered, so a failed write can be cut off again without leftovers in a buffer
+        return open(self._wal_path(sequence), 'ab', buffering=0)
+
+    def _wal_path(self, sequence):
+        return os.path.join(self._directory, f"wal-{sequence}.bin")
+
+    def _snapshot_path(self):
+        return os.path.join(self._directory, "snapshot.bin")
+
+    def _recover(self):
+        sequence = 0
+        path = self._snapshot_path()
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                magic, typecode, n_accounts, sequence = self._SNAPSHOT_HEADER.unpack(
+                    f.read(self._SNAPSHOT_HEADER.size))
+                if magic != self._SNAPSHOT_MAGIC or typecode.decode() != self._typecode:
+                    raise ValueError("Snapshot does not belong to this kind of ledger")
+                self._balances = array(self._typecode)
+                self._balances.fromfile(f, n_accounts)
+
+        records = 0
+        wal_path = self._wal_path(sequence)
+        if os.path.exists(wal_path):
+            with open(wal_path, 'rb') as f:
+                data = f.read()
+            size = self._record.size
+            usable = len(data) - len(data) % size  # a torn last record was never acknowledged
+            if usable != len(data):
+                with open(wal_path, 'r+b') as f:
+                    f.truncate(usable)
+            balances = self._balances
+            deposit, open_kind = TransactionBatch.DEPOSIT, self.OPEN
+            for kind, account_id, amount in self._record.iter_unpack(memoryview(data)[:usable]):
+                if kind == deposit:
+                    balances[account_id] += amount
+                elif kind == open_kind:
+                    balances.append(0)
+                else:
+                    balances[account_id] -= amount
+            records = usable // size
+        return sequence, records
+
+    def _append(self, payload, count):
+        # all or nothing: if the write fails part-way, the WAL is cut back to where it was
+        position = self._wal.tell()
+        try:
+            view = memoryview(payload)
+            while view:
+                view = view[self._wal.write(view):]
+            if self._sync:
+                os.fsync(self._wal.fileno())
+        except BaseException:
+            try:
+                self._wal.truncate(position)
+            except OSError:
+                pass
+            raise
+        self._wal_records += count
+
+    def _maybe_snapshot(self):
+        # runs once a change is in the WAL, so it must not undo that change: a failed automatic
+        # snapshot is kept in snapshot_error and the next change tries again
+        if self._wal_records >= self._snapshot_every:
+            try:
+                self.snapshot()
+            except OSError as error:
+                self.snapshot_error = error
+            else:
+                self.snapshot_error = None
+
+    def open_account(self):
+        account_id = super().open_account()
+        try:
+            self._append(self._record.pack(self.OPEN, account_id, 0), 1)
+        except BaseException:
+            self._balances.pop()
+            raise
+        self._maybe_snapshot()
+        return account_id
+
+    def _apply_batch(self, batch):
+        # the rows are checked and applied by Ledger, and the accepted ones are logged before
+        # returning. If the WAL write fails, the touched balances are restored, so the caller
+        # gets the exception and neither memory nor the WAL holds the batch.
+        balances = self._balances
+        n_accounts = len(balances)
+        saved = {account_id: balances[account_id] for account_id in set(batch.accounts)
+                 if 0 <= account_id < n_accounts}
+        rejected = super()._apply_batch(batch)
+        skip = {row for row, _ in rejected}
+        pack = self._record.pack
+        payload = b"".join(pack(kind, account_id, amount)
+                           for row, (account_id, amount, kind)
+                           in enumerate(zip(batch.accounts, batch.amounts, batch.kinds))
+                           if row not in skip)
+        try:
+            self._append(payload, len(batch) - len(skip))
+        except BaseException:
+            for account_id, balance in saved.items():
+                balances[account_id] = balance
+            raise
+        self._maybe_snapshot()
+        return rejected
+
+    def deposit(self, account_id, amount):
+        self._apply_one(account_id, amount, "deposit")
+
+    def withdraw(self, account_id, amount):
+        self._apply_one(account_id, amount, "withdraw")
+
+    def _apply_one(self, account_id, amount, kind):
+        rejected = self.apply([(account_id, amount, kind)])
+        if rejected:
+            raise ValueError(rejected[0][1])
+
+    def snapshot(self):
+        # write to a temporary file and rename it, so a crash leaves either the old or the new
+        # snapshot. Nothing about the current WAL changes until the rename succeeded: if any
+        # step before it fails, the ledger keeps using the old snapshot and WAL.
+        sequence = self._sequence + 1
+        tmp_path = self._snapshot_path() + ".tmp"
+        new_wal = None
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(self._SNAPSHOT_HEADER.pack(self._SNAPSHOT_MAGIC, self._typecode.encode(),
+                                                   len(self._balances), sequence))
+                self._balances.tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+            new_wal = self._open_wal(sequence)
+            os.replace(tmp_path, self._snapshot_path())
+        except BaseException:
+            if new_wal is not None:
+                new_wal.close()
+                os.remove(self._wal_path(sequence))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        old_wal = self._wal_path(self._sequence)
+        self._wal.close()
+        self._wal, self._sequence, self._wal_records = new_wal, sequence, 0
+        try:
+            os.remove(old_wal)
+        except OSError:
+            pass  # a leftover old WAL is never read again
+
+    def close(self):
+        self._wal.close()
+
+
+
+import tempfile
+
+with tempfile.TemporaryDirectory() as directory:
+    ledger = DurableLedger(directory)
+    alice, bob = ledger.open_account(), ledger.open_account()
+    ledger.apply([(alice, 100, "deposit"), (bob, 20, "deposit"), (bob, 50, "withdraw")])
+    ledger.snapshot()
+    ledger.withdraw(alice, 30)
+    ledger.close()
+
+    recovered = DurableLedger(directory)  # snapshot + one WAL record
+    print(recovered.balance(alice), recovered.balance(bob))  # 70.0 20.0
+    recovered.close()
+
+
+# In[ ]:
+
+
+# Checks for DurableLedger: recovery, a torn last WAL record, snapshot rotation, a failed WAL write
+# and a failed automatic snapshot
+import unittest
+from unittest.mock import patch
+
+class TestDurableLedger(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.directory = self._tmp.name
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_recovery_replays_the_wal(self):
+        ledger = DurableLedger(self.directory)
+        a, b = ledger.open_account(), ledger.open_account()
+        ledger.apply([(a, 100, "deposit"), (b, 5, "withdraw"), (a, 40, "withdraw")])
+        ledger.close()
+        recovered = DurableLedger(self.directory)
+        self.assertEqual(list(recovered._balances), [60.0, 0.0])
+        recovered.close()
+
+    def test_torn_last_record_is_dropped(self):
+        ledger = DurableLedger(self.directory)
+        a = ledger.open_account()
+        ledger.deposit(a, 10)
+        ledger.deposit(a, 20)
+        ledger.close()
+        wal = ledger._wal_path(0)
+        with open(wal, 'r+b') as f:
+            f.truncate(os.path.getsize(wal) - 3)
+        recovered = DurableLedger(self.directory)
+        self.assertEqual(recovered.balance(a), 10.0)
+        self.assertEqual(os.path.getsize(wal) % recovered._record.size, 0)
+        recovered.close()
+
+    def test_snapshot_rotation(self):
+        ledger = DurableLedger(self.directory, snapshot_every=3)
+        a = ledger.open_account()
+        for amount in (1, 2, 3, 4):
+            ledger.deposit(a, amount)  # the snapshot is taken after the 3rd WAL record
+        ledger.close()
+        self.assertEqual(sorted(os.listdir(self.directory)), ["snapshot.bin", "wal-1.bin"])
+        recovered = DurableLedger(self.directory)
+        self.assertEqual(recovered.balance(a), 10.0)
+        recovered.close()
+
+    def test_failed_wal_write_changes_nothing(self):
+        ledger = DurableLedger(self.directory)
+        a = ledger.open_account()
+        ledger.deposit(a, 50)
+        with patch.object(ledger, "_wal", wraps=ledger._wal) as wal:
+            wal.write.side_effect = OSError("disk full")
+            with self.assertRaises(OSError):
+                ledger.apply([(a, 10, "deposit"), (a, 30, "withdraw")])
+            with self.assertRaises(OSError):
+                ledger.open_account()
+        self.assertEqual(list(ledger._balances), [50.0])
+        ledger.close()
+        recovered = DurableLedger(self.directory)
+        self.assertEqual(list(recovered._balances), [50.0])
+        recovered.close()
+
+    def test_failed_snapshot_keeps_the_change(self):
+        ledger = DurableLedger(self.directory, snapshot_every=3)
+        a = ledger.open_account()
+        ledger.deposit(a, 10)
+        with patch.object(os, "replace", side_effect=OSError("disk full")):
+            ledger.deposit(a, 5)  # committed to the WAL; the snapshot after it fails
+        self.assertIsInstance(ledger.snapshot_error, OSError)
+        self.assertEqual(ledger.balance(a), 15.0)
+        self.assertEqual(sorted(os.listdir(self.directory)), ["wal-0.bin"])
+        ledger.deposit(a, 1)  # still usable, and this time the snapshot succeeds
+        self.assertIsNone(ledger.snapshot_error)
+        self.assertEqual(sorted(os.listdir(self.directory)), ["snapshot.bin", "wal-1.bin"])
+        ledger.close()
+        recovered = DurableLedger(self.directory)
+        self.assertEqual(recovered.balance(a), 16.0)
+        recovered.close()
+
+unittest.main(argv=['first-arg-is-ignored'], exit=False)
+
+
+# In[ ]:
+
+
+# Recovery benchmark: 10M accounts in the snapshot plus a WAL tail of 1M transactions
+import random
+import time
+
+def recovery_benchmark(n_accounts=10_000_000, wal_tail=1_000_000):
+    with tempfile.TemporaryDirectory() as directory:
+        ledger = DurableLedger(directory, snapshot_every=float("inf"))
+        ledger._balances = array(ledger._typecode, [100]) * n_accounts  # bulk-load, then snapshot
+        ledger.snapshot()
+        rng = random.Random(0)
+        ledger.apply([(rng.randrange(n_accounts), rng.randint(1, 50), rng.choice(("deposit", "withdraw")))
+                      for _ in range(wal_tail)])
+        ledger.close()
+
+        start = time.perf_counter()
+        recovered = DurableLedger(directory)
+        elapsed = time.perf_counter() - start
+        assert recovered._balances == ledger._balances
+        recovered.close()
+        print(f"recovered {n_accounts:,} accounts + {wal_tail:,} WAL records in {elapsed:.2f}s")
+
+recovery_benchmark()
+
+
+# In[ ]:
+
+
+# Fixed-point money (integer cents)
+# The encapsulated BankAccount keeps a float balance, and floats cannot represent most cent
+# amounts exactly (0.1 + 0.2 != 0.3), so balances drift. decimal.Decimal is exact but slow.
+# Money stores a whole number of cents in a plain int: exact, and int arithmetic is fast.
+# Amounts are turned into cents by to_cents(): ints, floats and plain "19.99" strings are
+# converted with int arithmetic, and Decimal is only the fallback for other notations.
+# Callers that already have int cents use the *_cents methods and skip parsing entirely.
+from decimal import Decimal
+from functools import total_ordering
+
+def to_cents(amount):
+    # exact: raises ValueError for amounts with more than two decimal places
+    kind = type(amount)
+    if kind is int:
+        return amount * 100  # whole units
+    if kind is float:
+        # the float is exact to the cent iff it is the double nearest to cents / 100
+        cents = round(amount * 100)
+        if cents / 100 != amount:
+            raise ValueError(f"{amount!r} has more than two decimal places")
+        return cents
+    if kind is str:
+        units, _, fraction = amount.partition(".")
+        if len(fraction) == 2 and units.isdigit() and fraction.isdigit() and amount.isascii():
+            return int(units + fraction)  # the common "12.34"
+    return _parse_cents(amount)
+
+def _parse_cents(amount):
+    if isinstance(amount, str):
+        # other plain forms: signs, surrounding spaces, "12", "12.", "12.3"
+        units, _, fraction = amount.strip().partition(".")
+        sign = -1 if units.startswith("-") else 1
+        if units[:1] in ("+", "-"):
+            units = units[1:]
+        if (units.isascii() and units.isdigit() and len(fraction) <= 2
+                and (not fraction or fraction.isascii() and fraction.isdigit())):
+            return sign * (int(units) * 100 + int(fraction.ljust(2, "0")))
+    # Decimal, int subclasses, and strings in other notations such as "1e3" or "1.230"
+    try:
+        cents = Decimal(amount) * 100
+    except ArithmeticError:
+        raise ValueError(f"Invalid amount: {amount!r}") from None
+    except TypeError:
+        raise TypeError(f"Unsupported amount type: {type(amount).__name__}") from None
+    if not cents.is_finite() or cents != cents.to_integral_value():
+        raise ValueError(f"{amount} has more than two decimal places")
+    return int(cents)
+
+@total_ordering
+class Money:
+    __slots__ = ('cents',)
+
+    def __init__(self, cents):
+        if not isinstance(cents, int):
+            raise TypeError("Money is built from an int number of cents, use Money.of()")
+        self.cents = cents
+
+    @classmethod
+    def of(cls, amount):
+        # accepts Money, int (whole units), str, Decimal or float
+        if isinstance(amount, Money):
+            return amount
+        return cls(to_cents(amount))
+
+    def __add__(self, other):
+        return Money(self.cents + other.cents)
+
+    def __sub__(self, other):
+        return Money(self.cents - other.cents)
+
+    def __neg__(self):
+        return Money(-self.cents)
+
+    def __eq__(self, other):
+        return isinstance(other, Money) and self.cents == other.cents
+
+    def __lt__(self, other):
+        return self.cents < other.cents
+
+    def __hash__(self):
+        return hash(self.cents)
+
+    def __str__(self):
+        sign = "-" if self.cents < 0 else ""
+        units, cents = divmod(abs(self.cents), 100)
+        return f"{sign}{units}.{cents:02d}"
+
+    def __repr__(self):
+        return f"Money('{self}')"
+
+
+# the encapsulated BankAccount with an exact integer-cents balance
+class CentsBankAccount:
+    def __init__(self):
+        self._balance = 0  # cents
+
+    @property
+    def balance(self):
+        return Money(self._balance)
+
+    def deposit(self,amount):
+        self.deposit_cents(amount.cents if isinstance(amount, Money) else to_cents(amount))
+
+    def withdraw(self,amount):
+        self.withdraw_cents(amount.cents if isinstance(amount, Money) else to_cents(amount))
+
+    def deposit_cents(self,cents):
+        if cents <= 0:
+            raise ValueError("Deposite amount must be positive")
+        self._balance += cents
+
+    def withdraw_cents(self,cents):
+        if cents <= 0:
+            raise ValueError("Withdraw amount must be positive")
+        if cents > self._balance:
+            raise ValueError("Insufficient funds")
+        self._balance -= cents
+
+
+# the batched ledgers with int64 cents columns instead of float64
+class CentsLedger(Ledger):
+    _typecode = 'q'
+
+    def _amount(self, amount):
+        return amount.cents if isinstance(amount, Money) else to_cents(amount)
+
+    def apply_cents(self, rows):
+        # like apply(), for rows whose amounts are already int cents: nothing is parsed
+        return self._apply_rows(rows, None)
+
+    def balance(self, account_id):
+        return Money(self._balances[account_id])
+
+class DurableCentsLedger(DurableLedger, CentsLedger):
+    pass
+
+
+account = CentsBankAccount()
+for _ in range(10):
+    account.deposit("0.10")
+print(account.balance)  # 1.00 exactly; ten float deposits of 0.1 give 0.9999999999999999
+
+ledger = CentsLedger(2)
+print(ledger.apply([(0, "19.99", "deposit"), (0, 5, "withdraw"), (1, 0.3, "withdraw"), (1, "1.234", "deposit")]))
+# [(2, 'Insufficient funds'), (3, '1.234 has more than two decimal places')]
+print(ledger.apply_cents([(1, 250, "deposit")]))  # [] (2.50 given as 250 cents)
+print(ledger.balance(0), ledger.balance(1))  # 14.99 2.50
+
+
+# In[ ]:
+
+
+# Money benchmark: 200k deposits/withdrawals through the actual APIs. A plain float and a plain
+# Decimal balance loop are the reference points; then CentsBankAccount and CentsLedger fed
+# with float amounts, "12.34" strings and int cents (deposit_cents / apply_cents)
+import random
+import time
+
+def timed(name, n, run):
+    start = time.perf_counter()
+    result = run()
+    elapsed = time.perf_counter() - start
+    print(f"{name:34s} {elapsed:6.3f} s  {n / elapsed:12,.0f} ops/s")
+    return result
+
+def money_benchmark(n=200_000, n_accounts=1_000):
+    rng = random.Random(0)
+    accounts = [rng.randrange(n_accounts) for _ in range(n)]
+    cents = [rng.randint(1, 10_000) for _ in range(n)]
+    kinds = ["deposit" if rng.random() < 0.5 else "withdraw" for _ in range(n)]
+    floats = [c / 100 for c in cents]
+    strings = [f"{c // 100}.{c % 100:02d}" for c in cents]
+
+    def plain_loop(amounts, zero):
+        balance = zero
+        for amount, kind in zip(amounts, kinds):
+            if kind == "deposit":
+                balance += amount
+            elif amount <= balance:
+                balance -= amount
+        return balance
+
+    def account_loop(amounts, deposit, withdraw):
+        account = CentsBankAccount()
+        for amount, kind in zip(amounts, kinds):
+            if kind == "deposit":
+                deposit(account, amount)
+            else:
+                try:
+                    withdraw(account, amount)
+                except ValueError:
+                    pass  # insufficient funds, skipped like in plain_loop
+        return account.balance
+
+    float_total = timed("float balance", n, lambda: plain_loop(floats, 0.0))
+    decimal_total = timed("Decimal balance", n, lambda: plain_loop([Decimal(s) for s in strings], Decimal(0)))
+    for name, amounts, deposit, withdraw in (
+            ("CentsBankAccount, floats", floats, CentsBankAccount.deposit, CentsBankAccount.withdraw),
+            ("CentsBankAccount, strings", strings, CentsBankAccount.deposit, CentsBankAccount.withdraw),
+            ("CentsBankAccount, int cents", cents, CentsBankAccount.deposit_cents, CentsBankAccount.withdraw_cents)):
+        total = timed(name, n, lambda: account_loop(amounts, deposit, withdraw))
+    print("float drifted from the exact total:", Decimal(float_total) != decimal_total,
+          "  cents total:", total, "  Decimal total:", decimal_total)
+
+    for name, amounts, method in (("CentsLedger.apply, floats", floats, CentsLedger.apply),
+                                  ("CentsLedger.apply, strings", strings, CentsLedger.apply),
+                                  ("CentsLedger.apply_cents", cents, CentsLedger.apply_cents)):
+        ledger = CentsLedger(n_accounts)
+        rows = list(zip(accounts, amounts, kinds))
+        timed(name, n, lambda: method(ledger, rows))
+    ledger = Ledger(n_accounts)
+    rows = list(zip(accounts, floats, kinds))
+    timed("Ledger.apply (float balances)", n, lambda: ledger.apply(rows))
+
+money_benchmark()
+
+
 # In[ ]:
 
 
@@ -1027,6 +2782,716 @@ email.disconnect()
 
 
 
+# In[ ]:
+
+
+# A local fake SMTP server, so email code can be tested and benchmarked offline.
+# It speaks just enough SMTP for smtplib (EHLO, AUTH PLAIN, MAIL, RCPT, DATA, NOOP, RSET, QUIT),
+# counts what it sees, and can add a delay to the connect and AUTH steps to mimic
+# a real server's handshake cost. RCPT to an address in reject_recipients gets "550 No such user".
+import socketserver
+import threading
+import time
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, handshake_delay=0.0, reject_recipients=()):
+        super().__init__((host, port), _FakeSMTPHandler)
+        self.handshake_delay = handshake_delay
+        self.reject_recipients = set(reject_recipients)
+        self.stats = {"connections": 0, "logins": 0, "messages": 0}
+        self.stats_lock = threading.Lock()
+
+    @property
+    def address(self):
+        return self.server_address[:2]
+
+    def count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+class _FakeSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        server.count("connections")
+        time.sleep(server.handshake_delay)
+        self.reply("220 fake-smtp ready")
+        for raw in self.rfile:
+            command = raw.decode().strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                self.reply("250-fake-smtp\r\n250-AUTH PLAIN\r\n250 OK")
+            elif verb == "HELO":
+                self.reply("250 fake-smtp")
+            elif verb == "AUTH":
+                time.sleep(server.handshake_delay)
+                server.count("logins")
+                self.reply("235 Authentication successful")
+            elif verb == "RCPT" and command[command.find("<") + 1:command.rfind(">")] in server.reject_recipients:
+                self.reply("550 No such user")
+            elif verb in ("MAIL", "RCPT", "RSET", "NOOP"):
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                for line in self.rfile:
+                    if line in (b".\r\n", b".\n"):
+                        break
+                server.count("messages")
+                self.reply("250 OK queued")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+# In[ ]:
+
+
+# Connection pooling
+# EmailService.send_email connects, authenticates and disconnects for every single message.
+# The pool keeps authenticated SMTP sessions open and hands them out again:
+# - at most max_size sessions exist at once (callers wait for a free one)
+# - sessions idle for longer than idle_timeout are closed instead of reused
+# - a session idle for longer than health_check_after is checked with NOOP before reuse
+# - a session whose connection fails while in use is thrown away, never returned to the pool;
+#   after an SMTP error reply (e.g. a rejected recipient) it is reset with RSET and kept
+import smtplib
+from collections import deque
+from contextlib import contextmanager
+from email.message import EmailMessage
+
+class SMTPConnectionPool:
+    def __init__(self, host, port, username, password, max_size=4,
+                 idle_timeout=60.0, health_check_after=5.0, timeout=10.0):
+        self._host = host
+        self._port = port
+        self._username = username
+        self._password = password
+        self._idle_timeout = idle_timeout
+        self._health_check_after = health_check_after
+        self._timeout = timeout
+        self._idle = deque()  # (session, last_used) pairs, most recently used on the right
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def _connect(self):
+        session = smtplib.SMTP(self._host, self._port, timeout=self._timeout)
+        session.login(self._username, self._password)
+        return session
+
+    @staticmethod
+    def _disconnect(session):
+        try:
+            session.quit()
+        except (smtplib.SMTPException, OSError):
+            session.close()
+
+    @staticmethod
+    def _is_healthy(session):
+        try:
+            return session.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    @staticmethod
+    def _reset(session):
+        # ends a failed transaction; False if the session is no longer usable
+        try:
+            return session.rset()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                session, last_used = self._idle.pop()
+            idle_for = time.monotonic() - last_used
+            if idle_for > self._idle_timeout:
+                self._disconnect(session)
+            elif idle_for > self._health_check_after and not self._is_healthy(session):
+                session.close()
+            else:
+                return session
+        return self._connect()
+
+    @contextmanager
+    def session(self):
+        with self._slots:
+            session = self._checkout()
+            try:
+                yield session
+            except smtplib.SMTPServerDisconnected:
+                session.close()
+                raise
+            except smtplib.SMTPException:
+                # the server answered with an error (e.g. a rejected recipient), so the
+                # connection itself still works. SMTPException is an OSError, so this must
+                # come before the OSError case.
+                if self._reset(session):
+                    self._checkin(session)
+                else:
+                    session.close()
+                raise
+            except OSError:
+                session.close()
+                raise
+            except BaseException:
+                # the caller's own error: the session may be mid-command, so check it first
+                if self._is_healthy(session):
+                    self._checkin(session)
+                else:
+                    session.close()
+                raise
+            else:
+                self._checkin(session)
+
+    def _checkin(self, session):
+        with self._lock:
+            self._idle.append((session, time.monotonic()))
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for session, _ in idle:
+            self._disconnect(session)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class PooledEmailService:
+    def __init__(self, pool, sender):
+        self._pool = pool
+        self._sender = sender
+
+    def send_email(self, to, subject, body):
+        message = EmailMessage()
+        message["From"] = self._sender
+        message["To"] = to
+        message["Subject"] = subject
+        message.set_content(body)
+        with self._pool.session() as session:
+            session.send_message(message)
+
+
+with FakeSMTPServer() as server:
+    with SMTPConnectionPool(*server.address, "hamed", "secret", max_size=2) as pool:
+        emails = PooledEmailService(pool, "noreply@example.com")
+        for i in range(5):
+            emails.send_email("bat@outlook.com", f"Hello #{i}", "Hi Batman")
+    print(server.stats)  # {'connections': 1, 'logins': 1, 'messages': 5}
+
+
+# In[ ]:
+
+
+# Checks for SMTPConnectionPool: a rejected recipient keeps the session, a dropped one is replaced
+import socket
+import unittest
+
+class TestSMTPConnectionPool(unittest.TestCase):
+    def test_rejected_recipient_keeps_the_session(self):
+        with FakeSMTPServer(reject_recipients={"nobody@example.com"}) as server:
+            with SMTPConnectionPool(*server.address, "hamed", "secret", max_size=1) as pool:
+                emails = PooledEmailService(pool, "noreply@example.com")
+                with self.assertRaises(smtplib.SMTPRecipientsRefused):
+                    emails.send_email("nobody@example.com", "Hello", "Hi")
+                emails.send_email("bat@outlook.com", "Hello", "Hi")
+            self.assertEqual(server.stats, {"connections": 1, "logins": 1, "messages": 1})
+
+    def test_dropped_session_is_replaced(self):
+        with FakeSMTPServer() as server:
+            with SMTPConnectionPool(*server.address, "hamed", "secret", max_size=1) as pool:
+                with self.assertRaises(smtplib.SMTPServerDisconnected):
+                    with pool.session() as session:
+                        session.sock.shutdown(socket.SHUT_RDWR)  # the connection drops while in use
+                        session.noop()
+                emails = PooledEmailService(pool, "noreply@example.com")
+                emails.send_email("bat@outlook.com", "Hello", "Hi")
+            self.assertEqual(server.stats, {"connections": 2, "logins": 2, "messages": 1})
+
+unittest.main(argv=['first-arg-is-ignored'], exit=False)
+
+
+# In[ ]:
+
+
+# Benchmark: a new connection per message (like EmailService.send_email) vs. the pool,
+# against the fake server with a 5 ms handshake delay, from 4 sending threads
+from concurrent.futures import ThreadPoolExecutor
+
+class ConnectPerMessageEmailService:
+    def __init__(self, host, port, username, password, sender):
+        self._address = (host, port)
+        self._credentials = (username, password)
+        self._sender = sender
+
+    def send_email(self, to, subject, body):
+        message = EmailMessage()
+        message["From"] = self._sender
+        message["To"] = to
+        message["Subject"] = subject
+        message.set_content(body)
+        with smtplib.SMTP(*self._address) as session:
+            session.login(*self._credentials)
+            session.send_message(message)
+
+def email_benchmark(n_messages=400, n_threads=4, handshake_delay=0.005):
+    with FakeSMTPServer(handshake_delay=handshake_delay) as server:
+        pool = SMTPConnectionPool(*server.address, "hamed", "secret", max_size=n_threads)
+        services = {
+            "connect per message": ConnectPerMessageEmailService(*server.address, "hamed", "secret",
+                                                                 "noreply@example.com"),
+            "pooled": PooledEmailService(pool, "noreply@example.com"),
+        }
+        for name, service in services.items():
+            before = dict(server.stats)
+            start = time.perf_counter()
+            with ThreadPoolExecutor(n_threads) as executor:
+                list(executor.map(lambda i: service.send_email("user@example.com", f"#{i}", "body"),
+                                  range(n_messages)))
+            elapsed = time.perf_counter() - start
+            print(f"{name:20s} {n_messages / elapsed:8,.0f} msgs/s   "
+                  f"connections: {server.stats['connections'] - before['connections']}")
+        pool.close()
+
+email_benchmark()
+
+
+# In[ ]:
+
+
+# asyncio EmailService with a bulk send pipeline
+# AsyncEmailService.send_many() streams messages through a bounded queue to a fixed number of
+# SMTP sessions, each served by one worker task:
+# - backpressure: the producer waits whenever queue_size messages are already waiting
+# - pipelining: MAIL, RCPT and DATA are written together and their replies read afterwards
+# - retries: a temporary failure (4xx reply or a dropped connection) is retried up to
+#   max_retries times after an exponential backoff with full jitter; 5xx replies are final
+# - addresses and subjects containing CR or LF are refused (ValueError), so a bulk-imported
+#   address cannot add SMTP commands or headers of its own
+# AsyncFakeSMTPServer is the asyncio stand-in server used to test and benchmark it offline.
+import asyncio
+import base64
+import random
+import time
+
+class AsyncFakeSMTPServer:
+    def __init__(self, host="127.0.0.1", port=0, handshake_delay=0.0, fail_every=0,
+                 fail_rcpt_every=0, reject_recipients=()):
+        self._host = host
+        self._port = port
+        self.handshake_delay = handshake_delay
+        self.fail_every = fail_every  # every Nth DATA gets "451 try again later" (0 = never)
+        self.fail_rcpt_every = fail_rcpt_every  # every Nth RCPT gets a 451 (0 = never)
+        self.reject_recipients = set(reject_recipients)  # RCPT to these gets "550 no such user"
+        self.stats = {"connections": 0, "messages": 0, "temporary_failures": 0}
+        self._data_commands = 0
+        self._rcpt_commands = 0
+        self._server = None
+        self._handlers = set()
+
+    @property
+    def address(self):
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def __aenter__(self):
+        self._server = await asyncio.start_server(self._handle, self._host, self._port)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._server.close()
+        # let open sessions finish before the event loop is torn down
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        self._handlers.add(asyncio.current_task())
+        self.stats["connections"] += 1
+        await asyncio.sleep(self.handshake_delay)
+        writer.write(b"220 fake-smtp ready\r\n")
+        recipients = 0  # accepted RCPTs in the current transaction
+        try:
+            async for raw in reader:
+                line = raw.decode().strip()
+                verb = line.split(" ", 1)[0].upper()
+                if verb == "EHLO":
+                    writer.write(b"250-fake-smtp\r\n250-PIPELINING\r\n250 AUTH PLAIN\r\n")
+                elif verb == "AUTH":
+                    await asyncio.sleep(self.handshake_delay)
+                    writer.write(b"235 Authentication successful\r\n")
+                elif verb == "RCPT":
+                    self._rcpt_commands += 1
+                    if line[line.find("<") + 1:line.rfind(">")] in self.reject_recipients:
+                        writer.write(b"550 No such user\r\n")
+                    elif self.fail_rcpt_every and self._rcpt_commands % self.fail_rcpt_every == 0:
+                        self.stats["temporary_failures"] += 1
+                        writer.write(b"451 Try again later\r\n")
+                    else:
+                        recipients += 1
+                        writer.write(b"250 OK\r\n")
+                elif verb in ("MAIL", "RSET", "NOOP"):
+                    recipients = 0
+                    writer.write(b"250 OK\r\n")
+                elif verb == "DATA":
+                    # like some real servers, DATA is accepted even when every RCPT failed;
+                    # the message is then refused after its final "."
+                    writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                    async for line in reader:
+                        if line == b".\r\n":
+                            break
+                    self._data_commands += 1
+                    if not recipients:
+                        writer.write(b"554 No valid recipients\r\n")
+                    elif self.fail_every and self._data_commands % self.fail_every == 0:
+                        self.stats["temporary_failures"] += 1
+                        writer.write(b"451 Try again later\r\n")
+                    else:
+                        self.stats["messages"] += 1
+                        writer.write(b"250 OK queued\r\n")
+                    recipients = 0
+                elif verb == "QUIT":
+                    writer.write(b"221 Bye\r\n")
+                    break
+                else:
+                    writer.write(b"502 Command not implemented\r\n")
+                await writer.drain()
+        finally:
+            writer.close()
+            self._handlers.discard(asyncio.current_task())
+
+def single_line(field, value):
+    # a CR or LF would end the SMTP command or header line early
+    if "\r" in value or "\n" in value:
+        raise ValueError(f"{field} must not contain CR or LF: {value!r}")
+    return value
+
+class SMTPReplyError(Exception):
+    def __init__(self, code, text):
+        super().__init__(f"{code} {text}")
+        self.code = code
+
+    @property
+    def temporary(self):
+        return 400 <= self.code < 500
+
+class AsyncSMTPSession:
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+
+    @classmethod
+    async def open(cls, host, port, username, password, timeout=10.0):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        session = cls(reader, writer)
+        await session._expect(220)
+        await session._command("EHLO localhost", 250)
+        token = base64.b64encode(f"\0{username}\0{password}".encode()).decode()
+        await session._command(f"AUTH PLAIN {token}", 235)
+        return session
+
+    async def _reply(self):
+        # multi-line replies use "250-" for every line but the last
+        while True:
+            line = (await self._reader.readline()).decode()
+            if not line:
+                raise ConnectionError("SMTP server closed the connection")
+            if line[3:4] != "-":
+                return int(line[:3]), line[4:].strip()
+
+    async def _expect(self, expected):
+        code, text = await self._reply()
+        if code != expected:
+            raise SMTPReplyError(code, text)
+
+    async def _command(self, line, expected):
+        self._writer.write(line.encode() + b"\r\n")
+        await self._writer.drain()
+        await self._expect(expected)
+
+    async def send(self, sender, recipients, body):
+        # pipelined envelope: one write, then one reply per command. Every reply is read
+        # before anything is raised, so none is left behind for the next message.
+        lines = ([f"MAIL FROM:<{single_line('sender', sender)}>"]
+                 + [f"RCPT TO:<{single_line('recipient', r)}>" for r in recipients] + ["DATA"])
+        self._writer.write("".join(line + "\r\n" for line in lines).encode())
+        await self._writer.drain()
+        replies = [await self._reply() for _ in lines]
+        failed = next((reply for reply in replies[:-1] if reply[0] != 250), None)
+        if replies[-1][0] != 354:
+            await self._command("RSET", 250)  # the envelope may be half accepted
+            raise SMTPReplyError(*(failed or replies[-1]))
+        if failed is not None:
+            # the server is waiting for the message: end it empty, then reset the transaction
+            self._writer.write(b".\r\n")
+            await self._writer.drain()
+            await self._reply()
+            await self._command("RSET", 250)
+            raise SMTPReplyError(*failed)
+        # dot-stuffing: a line starting with "." gets an extra "."
+        data = "\r\n".join("." + line if line.startswith(".") else line for line in body.splitlines())
+        self._writer.write(data.encode() + b"\r\n.\r\n")
+        await self._writer.drain()
+        await self._expect(250)
+
+    def abort(self):
+        # drops the connection without the QUIT exchange
+        self._writer.close()
+
+    async def close(self):
+        try:
+            await self._command("QUIT", 221)
+        except (ConnectionError, SMTPReplyError):
+            pass
+        self._writer.close()
+        await self._writer.wait_closed()
+
+class AsyncEmailService:
+    def __init__(self, host, port, username, password, sender, max_sessions=4,
+                 queue_size=100, max_retries=3, base_delay=0.05):
+        self._connect_args = (host, port, username, password)
+        self._sender = single_line("sender", sender)
+        self._max_sessions = max_sessions
+        self._queue_size = queue_size
+        self._max_retries = max_retries
+        self._base_delay = base_delay
+        self._idle = []
+        self._slots = None  # created lazily inside the running event loop
+        self.metrics = {"sent": 0, "failed": 0, "retries": 0, "sessions_opened": 0}
+
+    def _format(self, to, subject, body):
+        to, subject = single_line("recipient", to), single_line("subject", subject)
+        return f"From: {self._sender}\r\nTo: {to}\r\nSubject: {subject}\r\n\r\n{body}"
+
+    async def _open_session(self):
+        self.metrics["sessions_opened"] += 1
+        return await AsyncSMTPSession.open(*self._connect_args)
+
+    async def _deliver(self, session, to, subject, body):
+        # returns (session, error): the session to keep using (None after a dropped connection)
+        # and the exception that made the message fail, or None once it was sent. On any other
+        # exception (including cancellation) the session is dropped before it propagates.
+        try:
+            message = self._format(to, subject, body)
+        except ValueError as error:
+            self.metrics["failed"] += 1
+            return session, error
+        try:
+            for attempt in range(self._max_retries + 1):
+                try:
+                    if session is None:
+                        session = await self._open_session()
+                    await session.send(self._sender, [to], message)
+                    self.metrics["sent"] += 1
+                    return session, None
+                except SMTPReplyError as error:
+                    if not error.temporary or attempt == self._max_retries:
+                        self.metrics["failed"] += 1
+                        return session, error
+                except (ConnectionError, asyncio.TimeoutError) as error:
+                    if session is not None:
+                        session.abort()
+                        session = None
+                    if attempt == self._max_retries:
+                        self.metrics["failed"] += 1
+                        return None, error
+                self.metrics["retries"] += 1
+                await asyncio.sleep(random.uniform(0, self._base_delay * 2 ** attempt))
+        except BaseException:
+            if session is not None:
+                session.abort()
+            raise
+
+    async def send_email(self, to, subject, body):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._max_sessions)
+        async with self._slots:
+            session = self._idle.pop() if self._idle else None
+            session, error = await self._deliver(session, to, subject, body)
+            if session is not None:
+                self._idle.append(session)
+            if error is not None:
+                raise error
+
+    async def send_many(self, messages):
+        # messages is any iterable of (to, subject, body); returns a report with the failures
+        queue = asyncio.Queue(self._queue_size)
+        failures = []
+        start = time.perf_counter()
+        sent_before = self.metrics["sent"]
+
+        async def worker():
+            session = self._idle.pop() if self._idle else None
+            while True:
+                message = await queue.get()
+                try:
+                    if message is None:
+                        if session is not None:
+                            self._idle.append(session)
+                        return
+                    try:
+                        session, error = await self._deliver(session, *message)
+                    except Exception as error:
+                        session = None  # _deliver already dropped it
+                        failures.append((message, error))
+                    else:
+                        if error is not None:
+                            failures.append((message, error))
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self._max_sessions)]
+        try:
+            for message in messages:
+                await queue.put(message)  # waits while the queue is full
+        finally:
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        elapsed = time.perf_counter() - start
+        sent = self.metrics["sent"] - sent_before
+        return {"sent": sent, "failed": failures, "seconds": elapsed,
+                "messages_per_second": sent / elapsed if elapsed else 0.0}
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for session in idle:
+            await session.close()
+
+
+async def async_email_demo():
+    # every 4th DATA is refused with a 451, so some messages only get through on a retry
+    async with AsyncFakeSMTPServer(fail_every=4) as server:
+        emails = AsyncEmailService(*server.address, "hamed", "secret", "noreply@example.com",
+                                   max_sessions=2, queue_size=4, base_delay=0.01)
+        await emails.send_email("bat@outlook.com", "Hello", "Hi Batman")
+        report = await emails.send_many(("bat@outlook.com", f"Hello #{i}", "Hi Batman") for i in range(10))
+        await emails.close()
+    print(report["sent"], report["failed"])  # 10 []
+    print(emails.metrics)
+    print(server.stats)
+
+run_async(async_email_demo())
+
+
+# In[ ]:
+
+
+# Checks for AsyncEmailService: failed RCPT replies are all read, sessions go back to the pool,
+# and CR/LF in addresses or subjects is refused
+import unittest
+
+class TestAsyncEmailService(unittest.TestCase):
+    def run_with_server(self, scenario, **server_options):
+        async def run():
+            async with AsyncFakeSMTPServer(**server_options) as server:
+                emails = AsyncEmailService(*server.address, "hamed", "secret", "noreply@example.com",
+                                           max_sessions=1, base_delay=0.001)
+                try:
+                    # a reply left unread makes the client wait forever, so fail instead of hanging
+                    return await asyncio.wait_for(scenario(emails), 10), emails.metrics, server.stats
+                finally:
+                    await emails.close()
+        return run_async(run())
+
+    def test_temporary_rcpt_failure_is_retried(self):
+        async def scenario(emails):
+            return await emails.send_many(("bat@outlook.com", f"Hello #{i}", "Hi") for i in range(6))
+        report, metrics, stats = self.run_with_server(scenario, fail_rcpt_every=2)
+        self.assertEqual(report["failed"], [])
+        self.assertEqual(report["sent"], 6)
+        self.assertEqual(stats["messages"], 6)
+        self.assertEqual(metrics["retries"], stats["temporary_failures"])
+        self.assertEqual(stats["connections"], 1)
+
+    def test_permanent_rcpt_failure_keeps_the_session(self):
+        async def scenario(emails):
+            with self.assertRaises(SMTPReplyError) as caught:
+                await emails.send_email("nobody@example.com", "Hello", "Hi")
+            self.assertEqual(caught.exception.code, 550)
+            self.assertEqual(len(emails._idle), 1)
+            await emails.send_email("bat@outlook.com", "Hello", "Hi")
+        _, metrics, stats = self.run_with_server(scenario, reject_recipients={"nobody@example.com"})
+        self.assertEqual((metrics["sent"], metrics["failed"]), (1, 1))
+        self.assertEqual((stats["messages"], stats["connections"]), (1, 1))
+
+    def test_temporary_data_failure_is_retried(self):
+        async def scenario(emails):
+            return await emails.send_many(("bat@outlook.com", f"Hello #{i}", "Hi") for i in range(6))
+        report, metrics, stats = self.run_with_server(scenario, fail_every=3)
+        self.assertEqual((report["sent"], report["failed"]), (6, []))
+        self.assertEqual(metrics["retries"], 2)
+
+    def test_line_breaks_are_refused(self):
+        async def scenario(emails):
+            for to, subject in (("bat@outlook.com>\r\nRCPT TO:<joker@example.com", "Hello"),
+                                ("bat@outlook.com", "Hello\r\nBcc: joker@example.com"),
+                                ("bat@outlook.com\n", "Hello")):
+                with self.assertRaises(ValueError):
+                    await emails.send_email(to, subject, "Hi")
+            report = await emails.send_many([("joker@example.com\r\nDATA", "Hello", "Hi"),
+                                             ("bat@outlook.com", "Hello", "Hi")])
+            self.assertEqual(report["sent"], 1)
+            self.assertIsInstance(report["failed"][0][1], ValueError)
+            with self.assertRaises(ValueError):
+                await emails._idle[0].send("noreply@example.com", ["a@example.com\rRSET"], "Hi")
+        _, metrics, stats = self.run_with_server(scenario)
+        self.assertEqual((metrics["sent"], metrics["failed"]), (1, 4))
+        self.assertEqual((stats["messages"], stats["connections"]), (1, 1))
+
+unittest.main(argv=['first-arg-is-ignored'], exit=False)
+
+
+# In[ ]:
+
+
+# Benchmark: the threaded pool (4 threads, 4 connections) vs. AsyncEmailService.send_many
+# (4 pipelined sessions in one thread) against servers with a 5 ms handshake delay
+def async_email_benchmark(n_messages=2_000, n_sessions=4, handshake_delay=0.005):
+    with FakeSMTPServer(handshake_delay=handshake_delay) as server:
+        with SMTPConnectionPool(*server.address, "hamed", "secret", max_size=n_sessions) as pool:
+            emails = PooledEmailService(pool, "noreply@example.com")
+            start = time.perf_counter()
+            with ThreadPoolExecutor(n_sessions) as executor:
+                list(executor.map(lambda i: emails.send_email("user@example.com", f"#{i}", "body"),
+                                  range(n_messages)))
+            elapsed = time.perf_counter() - start
+    print(f"{'pooled threads':20s} {n_messages / elapsed:8,.0f} msgs/s")
+
+    async def run():
+        async with AsyncFakeSMTPServer(handshake_delay=handshake_delay) as server:
+            emails = AsyncEmailService(*server.address, "hamed", "secret", "noreply@example.com",
+                                       max_sessions=n_sessions)
+            report = await emails.send_many(("user@example.com", f"#{i}", "body")
+                                            for i in range(n_messages))
+            await emails.close()
+            return report, server.stats["connections"]
+
+    report, connections = run_async(run())
+    print(f"{'async send_many':20s} {report['messages_per_second']:8,.0f} msgs/s   "
+          f"connections: {connections}   failed: {len(report['failed'])}")
+
+async_email_benchmark()
+
+
 # In[ ]:
 
 
@@ -1336,20 +3801,37 @@ if __name__ == "__main__":
     print("Matrix Determinant:", MathUtils.determinant(m1))
 
 
-# In[63]:
+# In[ ]:
+
+
+get_ipython().run_cell_magic('writefile', 'math_entities.py', '\nimport math\nimport mmap\nimport operator\nimport struct\nimport sys\nfrom abc import ABC, abstractmethod\nfrom array import array\n\nclass MathEntity(ABC):\n    __slots__ = ()  # lets subclasses drop the per-instance __dict__\n\n    @abstractmethod\n    def add(self, other):\n        pass\n\n    @abstractmethod\n    def scale(self, scalar):\n        pass\n\n    def lazy(self):\n        # opt-in deferred arithmetic, see LazyExpr\n        return LazyExpr(\'leaf\', (self,))\n\nclass Vector(MathEntity):\n    __slots__ = (\'_x\', \'_y\', \'_z\', \'_magnitude\', \'_unit\')\n\n    def __init__(self, x, y, z=0):\n        self._x = x\n        self._y = y\n        self._z = z\n        self._magnitude = None  # cached by magnitude()\n        self._unit = None       # cached unit components, see unit()\n\n    def _invalidate(self):\n        # every mutation path must call this\n        self._magnitude = None\n        self._unit = None\n\n    def magnitude(self):\n        if self._magnitude is None:\n            self._magnitude = math.hypot(self._x, self._y, self._z)\n        return self._magnitude\n\n    def unit(self):\n        # a new Vector each call so callers can mutate it without corrupting the cache\n        if self._unit is None:\n            length = self.magnitude()\n            if length == 0:\n                raise ValueError("Cannot normalize a zero vector")\n            self._unit = (self._x / length, self._y / length, self._z / length)\n        unit = Vector(*self._unit)\n        unit._magnitude = 1.0\n        return unit\n\n    def add(self, other):\n        return Vector(self._x + other._x, self._y + other._y, self._z + other._z)\n\n    def scale(self, scalar):\n        return Vector(self._x * scalar, self._y * scalar, self._z * scalar)\n\n    def __add__(self, other):\n        return self.add(other)\n\n    # in-place variants mutate the accumulator instead of allocating a new Vector\n    def __iadd__(self, other):\n        self._x += other._x\n        self._y += other._y\n        self._z += other._z\n        self._invalidate()\n        return self\n\n    def __imul__(self, scalar):\n        self._x *= scalar\n        self._y *= scalar\n        self._z *= scalar\n        self._invalidate()\n        return self\n\n    def __str__(self):\n        return f"Vector({self._x}, {self._y}, {self._z})"\n\n# ===== VectorBatch Class =====\n# N vectors stored as three parallel array(\'d\') columns (struct-of-arrays);\n# every operation is one pass over the columns instead of N Vector objects\nclass VectorBatch(MathEntity):\n    __slots__ = (\'_xs\', \'_ys\', \'_zs\')\n\n    def __init__(self, xs, ys, zs=None):\n        self._xs = array(\'d\', xs)\n        self._ys = array(\'d\', ys)\n        self._zs = array(\'d\', zs) if zs is not None else array(\'d\', bytes(8 * len(self._xs)))\n        if not len(self._xs) == len(self._ys) == len(self._zs):\n            raise ValueError("Coordinate arrays must have the same length")\n\n    @classmethod\n    def from_vectors(cls, vectors):\n        vectors = list(vectors)\n        return cls([v._x for v in vectors], [v._y for v in vectors], [v._z for v in vectors])\n\n    def to_vectors(self):\n        return list(map(Vector, self._xs, self._ys, self._zs))\n\n    def __len__(self):\n        return len(self._xs)\n\n    def __getitem__(self, i):\n        return Vector(self._xs[i], self._ys[i], self._zs[i])\n\n    def __add__(self, other):\n        if not isinstance(other, VectorBatch):\n            raise ValueError("Can only add two VectorBatches")\n        if len(self) != len(other):\n            raise ValueError("VectorBatches must have the same length")\n        add = operator.add\n        return VectorBatch(map(add, self._xs, other._xs), map(add, self._ys, other._ys),\n                           map(add, self._zs, other._zs))\n\n    def add(self, other):\n        return self + other\n\n    def scale(self, scalar):\n        mul = float(scalar).__mul__\n        return VectorBatch(map(mul, self._xs), map(mul, self._ys), map(mul, self._zs))\n\n    def dot(self, other):\n        # element-wise dot products of the two batches\n        if not isinstance(other, VectorBatch):\n            raise ValueError("Can only take the dot product of two VectorBatches")\n        if len(self) != len(other):\n            raise ValueError("VectorBatches must have the same length")\n        mul = operator.mul\n        return array(\'d\', map(operator.add,\n                              map(operator.add, map(mul, self._xs, other._xs), map(mul, self._ys, other._ys)),\n                              map(mul, self._zs, other._zs)))\n\n    def magnitudes(self):\n        return array(\'d\', map(math.hypot, self._xs, self._ys, self._zs))\n\n    def normalize(self):\n        mags = self.magnitudes()\n        if 0.0 in mags:\n            raise ValueError("Cannot normalize a zero vector")\n        div = operator.truediv\n        return VectorBatch(map(div, self._xs, mags), map(div, self._ys, mags), map(div, self._zs, mags))\n\n    def __str__(self):\n        return f"VectorBatch({len(self)} vectors)"\n\n# ===== Matrix Class =====\n# Elements live in one contiguous row-major float64 buffer instead of nested lists:\n# an array(\'d\'), or a memoryview over someone else\'s memory (see frombuffer/open_mmap).\n# The owner of such memory can change it behind the Matrix\'s back, so factorizations of\n# these views are not cached.\nclass Matrix(MathEntity):\n    __slots__ = (\'_n_rows\', \'_n_cols\', \'_data\', \'_lu\')\n    BLOCK_SIZE = 64  # tile edge used by the blocked multiplication kernel\n    STRASSEN_CUTOFF = 128  # sub-problems at or below this size use the standard kernel\n    # file layout used by save/open_mmap: magic, version, byte order (0 little, 1 big),\n    # rows, cols; 24 bytes, so the float64 data after it stays 8-byte aligned\n    _FILE_HEADER = struct.Struct(\'<4sBB2xQQ\')\n    _FILE_MAGIC = b\'MTRX\'\n\n    def __init__(self, rows):\n        rows = [list(row) for row in rows]\n        n_cols = len(rows[0]) if rows else 0\n        if any(len(row) != n_cols for row in rows):\n            raise ValueError("All rows must have the same length")\n        self._n_rows = len(rows)\n        self._n_cols = n_cols\n        self._data = array(\'d\', [elem for row in rows for elem in row])\n        self._lu = None  # cached LU factorization, see _lu_factors()\n\n    @classmethod\n    def _from_buffer(cls, data, n_rows, n_cols):\n        # builds a Matrix around an existing flat buffer without copying it\n        matrix = cls.__new__(cls)\n        matrix._n_rows = n_rows\n        matrix._n_cols = n_cols\n        matrix._data = data\n        matrix._lu = None\n        return matrix\n\n    @classmethod\n    def frombuffer(cls, buffer, n_rows, n_cols):\n        # zero-copy view over any object exposing native float64 data (array, bytes, mmap, ...)\n        data = memoryview(buffer).cast(\'B\').cast(\'d\')\n        if len(data) != n_rows * n_cols:\n            raise ValueError("Buffer size does not match the requested shape")\n        return cls._from_buffer(data, n_rows, n_cols)\n\n    def memoryview(self):\n        # a 2-D float64 view of the elements, no copy; works on every supported Python\n        view = memoryview(self._data).cast(\'B\')\n        if self._n_rows and self._n_cols:\n            return view.cast(\'d\', self.shape)\n        return view.cast(\'d\')\n\n    def __buffer__(self, flags):\n        # buffer protocol (Python 3.12+): memoryview(matrix) is the same as matrix.memoryview()\n        return self.memoryview()\n\n    def save(self, path):\n        byte_order = 0 if sys.byteorder == \'little\' else 1\n        with open(path, \'wb\') as f:\n            f.write(self._FILE_HEADER.pack(self._FILE_MAGIC, 1, byte_order, self._n_rows, self._n_cols))\n            f.write(memoryview(self._data).cast(\'B\'))\n\n    @classmethod\n    def open_mmap(cls, path, mode="r"):\n        # maps a file written by save(); pages are loaded lazily by the OS on first touch.\n        # mode "r" is read-only, "r+" writes in-place updates back to the file and\n        # "c" is copy-on-write (changes stay in memory)\n        access = {"r": mmap.ACCESS_READ, "r+": mmap.ACCESS_WRITE, "c": mmap.ACCESS_COPY}\n        if mode not in access:\n            raise ValueError(f"Unknown mode: {mode}")\n        # copy-on-write never writes to the file, so only "r+" needs it opened for writing\n        with open(path, \'r+b\' if mode == "r+" else \'rb\') as f:\n            mapped = mmap.mmap(f.fileno(), 0, access=access[mode])\n        header_size = cls._FILE_HEADER.size\n        try:\n            if len(mapped) < header_size:\n                raise ValueError("Not a Matrix file")\n            magic, version, byte_order, n_rows, n_cols = cls._FILE_HEADER.unpack_from(mapped)\n            if magic != cls._FILE_MAGIC or version != 1:\n                raise ValueError("Not a Matrix file")\n            if byte_order != (0 if sys.byteorder == \'little\' else 1):\n                raise ValueError("Matrix file was written with a different byte order")\n            if len(mapped) != header_size + 8 * n_rows * n_cols:\n                raise ValueError("Matrix file is truncated")\n        except BaseException:\n            mapped.close()\n            raise\n        data = memoryview(mapped)[header_size:].cast(\'d\')\n        return cls._from_buffer(data, n_rows, n_cols)\n\n    @property\n    def shape(self):\n        return (self._n_rows, self._n_cols)\n\n    def tolist(self):\n        n = self._n_cols\n        return [self._data[i * n:(i + 1) * n].tolist() for i in range(self._n_rows)]\n\n    def __add__(self, other):\n        if isinstance(other, LazyExpr):\n            return NotImplemented  # LazyExpr.__radd__ keeps the expression lazy\n        if not isinstance(other, Matrix):\n            raise ValueError("Can only add two Matrices")\n        if self.shape != other.shape:\n            raise ValueError("Matrices must have the same shape")\n        data = array(\'d\', map(operator.add, self._data, other._data))\n        return Matrix._from_buffer(data, self._n_rows, self._n_cols)\n\n    def add(self, other):\n        return self + other\n\n    def __iadd__(self, other):\n        if not isinstance(other, Matrix):\n            raise ValueError("Can only add two Matrices")\n        if self.shape != other.shape:\n            raise ValueError("Matrices must have the same shape")\n        self._data[:] = array(\'d\', map(operator.add, self._data, other._data))\n        self._lu = None\n        return self\n\n    def __imul__(self, other):\n        # scalar: scale in place; Matrix: replace the contents with the product\n        if isinstance(other, Matrix):\n            product = self * other\n            self._data, self._n_cols = product._data, product._n_cols\n        else:\n            self._data[:] = array(\'d\', [elem * other for elem in self._data])\n        self._lu = None\n        return self\n\n    def scale(self, scalar):\n        data = array(\'d\', [elem * scalar for elem in self._data])\n        return Matrix._from_buffer(data, self._n_rows, self._n_cols)\n\n    def __mul__(self, other):\n        if isinstance(other, LazyExpr):\n            return NotImplemented  # LazyExpr.__rmul__ keeps the expression lazy\n        if not isinstance(other, Matrix):\n            raise ValueError("Can only multiply two Matrices")\n        if self._n_cols != other._n_rows:\n            raise ValueError("Matrix dimensions do not match for multiplication")\n        data = _blocked_matmul(self._data, other._data, self._n_rows, self._n_cols,\n                               other._n_cols, self.BLOCK_SIZE)\n        return Matrix._from_buffer(data, self._n_rows, other._n_cols)\n\n    def matmul(self, other, algorithm="blocked", **options):\n        # algorithm="blocked" is the serial kernel used by *; "strassen" recurses down to\n        # the cutoff option (default STRASSEN_CUTOFF), for near-square operands only (others\n        # use the blocked kernel); "parallel" splits the rows across\n        # processes (options: workers, threshold, executor; see math_parallel)\n        if algorithm == "blocked":\n            return self * other\n        if algorithm == "strassen":\n            return self._strassen(other, **options)\n        if algorithm == "parallel":\n            from math_parallel import parallel_matmul\n            return parallel_matmul(self, other, **options)\n        raise ValueError(f"Unknown multiplication algorithm: {algorithm}")\n\n    def _strassen(self, other, cutoff=None):\n        if not isinstance(other, Matrix):\n            raise ValueError("Can only multiply two Matrices")\n        if self._n_cols != other._n_rows:\n            raise ValueError("Matrix dimensions do not match for multiplication")\n        cutoff = max(self.STRASSEN_CUTOFF if cutoff is None else cutoff, 1)\n        n, m, p = self._n_rows, self._n_cols, other._n_cols\n        # padding to a square of the largest dimension only pays off for operands that are\n        # square or close to it; a 1x400 by 400x1 product would become 400x400 by 400x400\n        if max(n, m, p) > 2 * min(n, m, p):\n            return self * other\n        # pad to leaf * 2**levels with leaf <= cutoff, so every split is even and the\n        # padding stays below one leaf\'s worth of rows instead of the next power of two\n        largest = max(n, m, p)\n        levels = 0\n        while -(-largest // 2 ** levels) > cutoff:\n            levels += 1\n        size = -(-largest // 2 ** levels) * 2 ** levels\n        a = _padded_rows(self._data, n, m, size)\n        b = _padded_rows(other._data, m, p, size)\n        c = _strassen_rows(a, b, cutoff)\n        data = array(\'d\')\n        for row in c[:n]:\n            data.extend(row[:p])\n        return Matrix._from_buffer(data, n, p)\n\n    def _lu_factors(self):\n        # factorized once per matrix; later solves against it only pay O(n^2). A view over\n        # external memory (frombuffer/open_mmap) is factorized again on every call, since\n        # its elements can change without the Matrix knowing.\n        if self._lu is None:\n            if self._n_rows != self._n_cols:\n                raise ValueError("Matrix must be square")\n            factors = _lu_decompose(self.tolist())\n            if not isinstance(self._data, array):\n                return factors\n            self._lu = factors\n        return self._lu\n\n    def __str__(self):\n        return f"Matrix({self.tolist()})"\n\ndef _blocked_matmul(a, b, n, m, p, block):\n    # a is n x m, b is m x p (both flat, row-major); returns the flat n x p product.\n    # Rows of a and columns of b are unpacked once into lists (so the floats are boxed\n    # once, not on every pass) and each cell is a single sum(map(mul, row, col))\n    # instead of m strided lookups. The output is filled\n    # tile by tile so the same block of columns is reused by a block of rows.\n    rows = [a[i * m:(i + 1) * m].tolist() for i in range(n)]\n    cols = [b[j::p].tolist() for j in range(p)]\n    mul = operator.mul\n    out = array(\'d\', bytes(8 * n * p))\n    for i0 in range(0, n, block):\n        for j0 in range(0, p, block):\n            col_block = cols[j0:j0 + block]\n            j1 = j0 + len(col_block)\n            for i in range(i0, min(i0 + block, n)):\n                row = rows[i]\n                out[i * p + j0:i * p + j1] = array(\'d\', [sum(map(mul, row, col)) for col in col_block])\n    return out\n\n# ===== Strassen Multiplication =====\ndef _padded_rows(data, n_rows, n_cols, size):\n    zeros = [0.0] * (size - n_cols)\n    rows = [data[i * n_cols:(i + 1) * n_cols].tolist() + zeros for i in range(n_rows)]\n    rows.extend([0.0] * size for _ in range(size - n_rows))\n    return rows\n\ndef _add_rows(a, b):\n    add = operator.add\n    return [list(map(add, r1, r2)) for r1, r2 in zip(a, b)]\n\ndef _sub_rows(a, b):\n    sub = operator.sub\n    return [list(map(sub, r1, r2)) for r1, r2 in zip(a, b)]\n\ndef _strassen_rows(a, b, cutoff):\n    # a and b are square lists of rows whose size halves evenly down to the cutoff\n    n = len(a)\n    if n <= cutoff or n % 2:\n        mul = operator.mul\n        cols = list(zip(*b))\n        return [[sum(map(mul, row, col)) for col in cols] for row in a]\n    h = n // 2\n    a11 = [row[:h] for row in a[:h]]\n    a12 = [row[h:] for row in a[:h]]\n    a21 = [row[:h] for row in a[h:]]\n    a22 = [row[h:] for row in a[h:]]\n    b11 = [row[:h] for row in b[:h]]\n    b12 = [row[h:] for row in b[:h]]\n    b21 = [row[:h] for row in b[h:]]\n    b22 = [row[h:] for row in b[h:]]\n    m1 = _strassen_rows(_add_rows(a11, a22), _add_rows(b11, b22), cutoff)\n    m2 = _strassen_rows(_add_rows(a21, a22), b11, cutoff)\n    m3 = _strassen_rows(a11, _sub_rows(b12, b22), cutoff)\n    m4 = _strassen_rows(a22, _sub_rows(b21, b11), cutoff)\n    m5 = _strassen_rows(_add_rows(a11, a12), b22, cutoff)\n    m6 = _strassen_rows(_sub_rows(a21, a11), _add_rows(b11, b12), cutoff)\n    m7 = _strassen_rows(_sub_rows(a12, a22), _add_rows(b21, b22), cutoff)\n    c11 = _add_rows(_sub_rows(_add_rows(m1, m4), m5), m7)\n    c12 = _add_rows(m3, m5)\n    c21 = _add_rows(m2, m4)\n    c22 = _add_rows(_add_rows(_sub_rows(m1, m2), m3), m6)\n    return [r1 + r2 for r1, r2 in zip(c11, c12)] + [r1 + r2 for r1, r2 in zip(c21, c22)]\n\n# ===== LU Factorization (partial pivoting) =====\ndef _lu_decompose(rows):\n    # In-place Doolittle elimination: returns (lu, perm, sign, singular) where lu holds\n    # the unit-lower factor L below the diagonal and U on and above it, and\n    # perm[i] is the original row that ended up in position i.\n    n = len(rows)\n    perm = list(range(n))\n    sign = 1.0\n    singular = False\n    sub = operator.sub\n    for k in range(n):\n        pivot_row = max(range(k, n), key=lambda i: abs(rows[i][k]))\n        pivot = rows[pivot_row][k]\n        if pivot == 0:\n            singular = True\n            continue\n        if pivot_row != k:\n            rows[k], rows[pivot_row] = rows[pivot_row], rows[k]\n            perm[k], perm[pivot_row] = perm[pivot_row], perm[k]\n            sign = -sign\n        row_k = rows[k]\n        tail_k = row_k[k + 1:]\n        for i in range(k + 1, n):\n            row_i = rows[i]\n            factor = row_i[k] / pivot\n            row_i[k] = factor\n            if factor:\n                row_i[k + 1:] = map(sub, row_i[k + 1:], map(factor.__mul__, tail_k))\n    return rows, perm, sign, singular\n\ndef _lu_solve(factors, b):\n    # forward substitution with unit-lower L, then back substitution with U\n    lu, perm, _, singular = factors\n    if singular:\n        raise ValueError("Matrix is singular")\n    n = len(lu)\n    y = [float(b[p]) for p in perm]\n    for i in range(1, n):\n        row = lu[i]\n        y[i] -= sum(map(operator.mul, row[:i], y[:i]))\n    for i in range(n - 1, -1, -1):\n        row = lu[i]\n        y[i] = (y[i] - sum(map(operator.mul, row[i + 1:], y[i + 1:]))) / row[i]\n    return y\n\n# ===== SparseMatrix Class =====\n# Compressed sparse row (CSR) storage: the nonzeros of row i are\n# values[indptr[i]:indptr[i + 1]] at columns indices[indptr[i]:indptr[i + 1]].\n# add/scale/multiply only touch stored nonzeros.\nclass SparseMatrix(MathEntity):\n    __slots__ = (\'_n_rows\', \'_n_cols\', \'_indptr\', \'_indices\', \'_values\')\n\n    def __init__(self, n_rows, n_cols, entries=()):\n        # entries are COO triples (row, col, value); duplicates are summed\n        merged = {}\n        for i, j, value in entries:\n            if not (0 <= i < n_rows and 0 <= j < n_cols):\n                raise ValueError("Entry index out of range")\n            merged[i, j] = merged.get((i, j), 0.0) + value\n        per_row = [[] for _ in range(n_rows)]\n        for (i, j), value in merged.items():\n            if value:\n                per_row[i].append((j, value))\n        self._set_rows(n_rows, n_cols, per_row)\n\n    def _set_rows(self, n_rows, n_cols, per_row):\n        # per_row[i] is a list of (col, value) pairs for row i\n        indptr = array(\'q\', [0])\n        indices = array(\'q\')\n        values = array(\'d\')\n        for row in per_row:\n            row.sort()\n            indices.extend([j for j, _ in row])\n            values.extend([v for _, v in row])\n            indptr.append(len(indices))\n        self._n_rows = n_rows\n        self._n_cols = n_cols\n        self._indptr = indptr\n        self._indices = indices\n        self._values = values\n\n    @classmethod\n    def _from_rows(cls, n_rows, n_cols, per_row):\n        sparse = cls.__new__(cls)\n        sparse._set_rows(n_rows, n_cols, per_row)\n        return sparse\n\n    @classmethod\n    def from_matrix(cls, matrix):\n        n_rows, n_cols = matrix.shape\n        data = matrix._data\n        per_row = [[(j, v) for j, v in enumerate(data[i * n_cols:(i + 1) * n_cols]) if v]\n                   for i in range(n_rows)]\n        return cls._from_rows(n_rows, n_cols, per_row)\n\n    def to_matrix(self):\n        data = array(\'d\', bytes(8 * self._n_rows * self._n_cols))\n        for i, j, value in self.entries():\n            data[i * self._n_cols + j] = value\n        return Matrix._from_buffer(data, self._n_rows, self._n_cols)\n\n    @property\n    def shape(self):\n        return (self._n_rows, self._n_cols)\n\n    @property\n    def nnz(self):\n        return len(self._values)\n\n    def _row(self, i):\n        start, end = self._indptr[i], self._indptr[i + 1]\n        return self._indices[start:end], self._values[start:end]\n\n    def entries(self):\n        # yields (row, col, value) for every stored nonzero\n        for i in range(self._n_rows):\n            cols, values = self._row(i)\n            for j, value in zip(cols, values):\n                yield i, j, value\n\n    def __add__(self, other):\n        if not isinstance(other, SparseMatrix):\n            raise ValueError("Can only add two SparseMatrices")\n        if self.shape != other.shape:\n            raise ValueError("Matrices must have the same shape")\n        per_row = []\n        for i in range(self._n_rows):\n            acc = dict(zip(*self._row(i)))\n            for j, value in zip(*other._row(i)):\n                acc[j] = acc.get(j, 0.0) + value\n            per_row.append([(j, v) for j, v in acc.items() if v])\n        return SparseMatrix._from_rows(self._n_rows, self._n_cols, per_row)\n\n    def add(self, other):\n        return self + other\n\n    def scale(self, scalar):\n        if not scalar:\n            return SparseMatrix(self._n_rows, self._n_cols)\n        sparse = SparseMatrix.__new__(SparseMatrix)\n        sparse._n_rows, sparse._n_cols = self._n_rows, self._n_cols\n        sparse._indptr = array(\'q\', self._indptr)\n        sparse._indices = array(\'q\', self._indices)\n        sparse._values = array(\'d\', [v * scalar for v in self._values])\n        return sparse\n\n    def __mul__(self, other):\n        if isinstance(other, SparseMatrix):\n            return self._mul_sparse(other)\n        if isinstance(other, Matrix):\n            return self._mul_dense(other)\n        raise ValueError("Can only multiply by a SparseMatrix or Matrix")\n\n    def _mul_dense(self, other):\n        # each stored a_ik adds a_ik * (row k of other) into row i of the result\n        if self._n_cols != other._n_rows:\n            raise ValueError("Matrix dimensions do not match for multiplication")\n        p = other._n_cols\n        b = other._data\n        out = array(\'d\', bytes(8 * self._n_rows * p))\n        for i in range(self._n_rows):\n            cols, values = self._row(i)\n            if not cols:\n                continue\n            acc = [0.0] * p\n            for k, a_ik in zip(cols, values):\n                acc = list(map(operator.add, acc, map(a_ik.__mul__, b[k * p:(k + 1) * p])))\n            out[i * p:(i + 1) * p] = array(\'d\', acc)\n        return Matrix._from_buffer(out, self._n_rows, p)\n\n    def _mul_sparse(self, other):\n        # Gustavson\'s row-by-row product: cost follows the nonzeros that meet\n        if self._n_cols != other._n_rows:\n            raise ValueError("Matrix dimensions do not match for multiplication")\n        per_row = []\n        for i in range(self._n_rows):\n            acc = {}\n            for k, a_ik in zip(*self._row(i)):\n                for j, b_kj in zip(*other._row(k)):\n                    acc[j] = acc.get(j, 0.0) + a_ik * b_kj\n            per_row.append([(j, v) for j, v in acc.items() if v])\n        return SparseMatrix._from_rows(self._n_rows, other._n_cols, per_row)\n\n    def __str__(self):\n        return f"SparseMatrix({self._n_rows}x{self._n_cols}, nnz={self.nnz})"\n\n# ===== Lazy Expressions =====\n# Operators on a LazyExpr only record a tree; evaluate() materializes it.\n# Chains of add/scale are linear, so they are folded into one weighted sum of\n# their operands and computed in a single pass over the Matrix buffers,\n# without building any intermediate Matrix.\n# Leaves refer to their entities, not copies: evaluate() always reads their current\n# values (so it sees in-place updates such as m += m) and nothing is cached between calls.\n# The tree is walked with explicit stacks, so long accumulated chains don\'t hit the\n# recursion limit.\nclass LazyExpr(MathEntity):\n    __slots__ = (\'_op\', \'_args\')\n\n    def __init__(self, op, args):\n        self._op = op  # \'leaf\', \'add\', \'scale\' or \'mul\'\n        self._args = args\n\n    @staticmethod\n    def _wrap(entity):\n        return entity if isinstance(entity, LazyExpr) else entity.lazy()\n\n    def __add__(self, other):\n        return LazyExpr(\'add\', (self, LazyExpr._wrap(other)))\n\n    def __radd__(self, other):\n        return LazyExpr(\'add\', (LazyExpr._wrap(other), self))\n\n    def add(self, other):\n        return self + other\n\n    def scale(self, scalar):\n        return LazyExpr(\'scale\', (self, scalar))\n\n    def __mul__(self, other):\n        return LazyExpr(\'mul\', (self, LazyExpr._wrap(other)))\n\n    def __rmul__(self, other):\n        return LazyExpr(\'mul\', (LazyExpr._wrap(other), self))\n\n    def _linear_terms(self, coeff, terms):\n        # flattens add/scale nodes into {key: [node, coefficient]}; leaves wrapping\n        # the same entity share a key so their coefficients are merged\n        stack = [(self, coeff)]\n        while stack:\n            node, coeff = stack.pop()\n            if node._op == \'add\':\n                stack.append((node._args[1], coeff))\n                stack.append((node._args[0], coeff))\n            elif node._op == \'scale\':\n                stack.append((node._args[0], coeff * node._args[1]))\n            else:\n                key = id(node._args[0]) if node._op == \'leaf\' else id(node)\n                terms.setdefault(key, [node, 0])[1] += coeff\n\n    def evaluate(self):\n        # post-order walk: a node is computed once all of its operands have values.\n        # values and terms are keyed by id() and only live for this call.\n        values = {}\n        linear = {}  # id(add/scale node) -> its flattened terms\n        stack = [self]\n        while stack:\n            node = stack[-1]\n            if id(node) in values:\n                stack.pop()\n                continue\n            if node._op == \'leaf\':\n                values[id(node)] = node._args[0]\n                stack.pop()\n                continue\n            if node._op == \'mul\':\n                operands = node._args\n            else:\n                if id(node) not in linear:\n                    terms = {}\n                    node._linear_terms(1, terms)\n                    linear[id(node)] = list(terms.values())\n                operands = [operand for operand, _ in linear[id(node)]]\n            pending = [operand for operand in operands if id(operand) not in values]\n            if pending:\n                stack.extend(pending)\n                continue\n            stack.pop()\n            if node._op == \'mul\':\n                values[id(node)] = values[id(operands[0])] * values[id(operands[1])]\n            else:\n                values[id(node)] = _weighted_sum([(values[id(operand)], c) for operand, c in linear[id(node)]])\n        return values[id(self)]\n\n    def __str__(self):\n        return f"LazyExpr({self._op})"\n\ndef _weighted_sum(terms):\n    # terms is a list of (entity, coefficient); Matrix operands are fused into one pass\n    entities = [entity for entity, _ in terms]\n    if not all(isinstance(entity, Matrix) for entity in entities):\n        result = None\n        for entity, c in terms:\n            part = entity if c == 1 else entity.scale(c)\n            result = part if result is None else result + part\n        return result\n    shape = entities[0].shape\n    if any(entity.shape != shape for entity in entities):\n        raise ValueError("Matrices must have the same shape")\n    buffers = [entity._data for entity in entities]\n    coeffs = [c for _, c in terms]\n    if len(terms) == 1:\n        (c0,), (d0,) = coeffs, buffers\n        data = array(\'d\', [c0 * x for x in d0])\n    elif len(terms) == 2:\n        (c0, c1), (d0, d1) = coeffs, buffers\n        data = array(\'d\', [c0 * x + c1 * y for x, y in zip(d0, d1)])\n    else:\n        mul = operator.mul\n        data = array(\'d\', [sum(map(mul, coeffs, values)) for values in zip(*buffers)])\n    return Matrix._from_buffer(data, *shape)\n\n# ===== Utility Functions (Composition) =====\nclass MathUtils:\n    @staticmethod\n    def magnitude(vector):\n        if isinstance(vector, VectorBatch):\n            return vector.magnitudes()\n        return vector.magnitude()  # cached on the Vector, computed with math.hypot\n\n    @staticmethod\n    def determinant(matrix):\n        if matrix.shape == (2, 2):\n            a, b, c, d = matrix._data\n            return a*d - b*c\n        lu, _, sign, singular = matrix._lu_factors()\n        if singular:\n            return 0.0\n        det = sign\n        for i, row in enumerate(lu):\n            det *= row[i]\n        return det\n\n    @staticmethod\n    def solve(matrix, b):\n        # b is a sequence of length n, or a Matrix whose columns are right-hand sides\n        factors = matrix._lu_factors()\n        if isinstance(b, Matrix):\n            if b._n_rows != matrix._n_rows:\n                raise ValueError("Right-hand side has the wrong number of rows")\n            p = b._n_cols\n            columns = [_lu_solve(factors, b._data[j::p]) for j in range(p)]\n            return Matrix([list(row) for row in zip(*columns)])\n        if len(b) != matrix._n_rows:\n            raise ValueError("Right-hand side has the wrong number of rows")\n        return _lu_solve(factors, b)\n\n    @staticmethod\n    def inverse(matrix):\n        factors = matrix._lu_factors()\n        n = matrix._n_rows\n        columns = [_lu_solve(factors, [1.0 if i == j else 0.0 for i in range(n)]) for j in range(n)]\n        return Matrix([list(row) for row in zip(*columns)])\n\n# ===== Main Program =====\nif __name__ == "__main__":\n    v1 = Vector(2, 3, 1)\n    v2 = Vector(4, 1, 1)\n\n    print(v1)  # Vector(2, 3)\n    print(v2)  # Vector(4, 1)\n    print("Vector Add:", v1.add(v2))\n    print("Vector Scale (2x):", v1.scale(2))\n    print("Vector Magnitude:", MathUtils.magnitude(v1))\n    print("Unit Vector:", v1.unit())\n\n    batch = VectorBatch.from_vectors([v1, v2])\n    print("Batch Add:", [str(v) for v in (batch + batch).to_vectors()])\n    print("Batch Magnitudes:", MathUtils.magnitude(batch).tolist())\n\n    m1 = Matrix([[1,2], [3,4]])\n    m2 = Matrix([[5,6], [7,8]])\n\n    print(m1)  # Matrix([[1.0, 2.0], [3.0, 4.0]])\n    print(m2)  # Matrix([[5.0, 6.0], [7.0, 8.0]])\n    print("Matrix Add:", m1.add(m2))\n    print("Matrix Scale (3x):", m1.scale(3))\n    print("Matrix Determinant:", MathUtils.determinant(m1))\n\n    expr = (m1.lazy() + m2).scale(3) * m1  # nothing is computed yet\n    print("Lazy (m1 + m2) * 3 * m1:", expr.evaluate())\n\n    s1 = SparseMatrix(3, 3, [(0, 0, 1), (1, 2, 4), (2, 1, 2)])\n    print(s1)  # SparseMatrix(3x3, nnz=3)\n    print("Sparse x Dense:", s1 * Matrix([[1, 0, 0], [0, 1, 0], [0, 0, 1]]))\n    print("Sparse x Sparse:", (s1 * s1).to_matrix())\n\n    m3 = Matrix([[2, 1, 1], [4, -6, 0], [-2, 7, 2]])\n    print("3x3 Determinant:", MathUtils.determinant(m3))  # -16.0\n    print("Solve m3 x = [5, -2, 9]:", MathUtils.solve(m3, [5, -2, 9]))  # [1.0, 1.0, 2.0]\n    print("Inverse:", MathUtils.inverse(m3))\n')
+
+
+# In[ ]:
+
+
+get_ipython().run_cell_magic('writefile', 'math_parallel.py', '\nimport os\nfrom array import array\nfrom concurrent.futures import ProcessPoolExecutor\nfrom multiprocessing.shared_memory import SharedMemory\n\nfrom math_entities import Matrix, _blocked_matmul\n\n# multiply-add count (n * m * p) below which process start-up costs more than it saves\nPARALLEL_THRESHOLD = 96 ** 3\n\ndef parallel_matmul(a, b, workers=None, threshold=PARALLEL_THRESHOLD, executor=None):\n    if not isinstance(a, Matrix) or not isinstance(b, Matrix):\n        raise ValueError("Can only multiply two Matrices")\n    if a._n_cols != b._n_rows:\n        raise ValueError("Matrix dimensions do not match for multiplication")\n    n, m, p = a._n_rows, a._n_cols, b._n_cols\n    workers = min(workers or os.cpu_count() or 1, n)\n    if n * m * p < threshold or workers < 2:\n        return a * b\n\n    # operands and result live in shared memory; only block names and row ranges are pickled\n    blocks = []\n    try:\n        shm_a = _shared_copy(a._data, blocks)\n        shm_b = _shared_copy(b._data, blocks)\n        shm_out = _shared_block(8 * n * p, blocks)\n        step = -(-n // workers)\n        tasks = [(shm_a.name, shm_b.name, shm_out.name, r0, min(r0 + step, n), m, p, a.BLOCK_SIZE)\n                 for r0 in range(0, n, step)]\n        if executor is None:\n            with ProcessPoolExecutor(max_workers=workers) as pool:\n                list(pool.map(_multiply_rows, tasks))\n        else:\n            list(executor.map(_multiply_rows, tasks))\n        data = array(\'d\')\n        data.frombytes(shm_out.buf[:8 * n * p])\n    finally:\n        for shm in blocks:\n            shm.close()\n            shm.unlink()\n    return Matrix._from_buffer(data, n, p)\n\ndef _shared_block(size, blocks):\n    shm = SharedMemory(create=True, size=max(size, 1))\n    blocks.append(shm)\n    return shm\n\ndef _shared_copy(data, blocks):\n    raw = data.tobytes()\n    shm = _shared_block(len(raw), blocks)\n    shm.buf[:len(raw)] = raw\n    return shm\n\ndef _multiply_rows(task):\n    # runs in a worker: computes rows [r0, r1) of the product straight into shared memory\n    a_name, b_name, out_name, r0, r1, m, p, block = task\n    shm_a, shm_b, shm_out = SharedMemory(name=a_name), SharedMemory(name=b_name), SharedMemory(name=out_name)\n    try:\n        a = array(\'d\')\n        a.frombytes(shm_a.buf[8 * r0 * m:8 * r1 * m])\n        b = array(\'d\')\n        b.frombytes(shm_b.buf[:8 * m * p])\n        rows = _blocked_matmul(a, b, r1 - r0, m, p, block)\n        shm_out.buf[8 * r0 * p:8 * r1 * p] = rows.tobytes()\n    finally:\n        shm_a.close()\n        shm_b.close()\n        shm_out.close()\n\nif __name__ == "__main__":\n    import random\n    import time\n\n    size = 300\n    m1 = Matrix([[random.random() for _ in range(size)] for _ in range(size)])\n    m2 = Matrix([[random.random() for _ in range(size)] for _ in range(size)])\n    for algorithm in ("blocked", "parallel"):\n        start = time.perf_counter()\n        m1.matmul(m2, algorithm=algorithm)\n        print(f"{algorithm:8s} {size}x{size}: {time.perf_counter() - start:.3f}s")\n')
+
+
+# In[ ]:
 
 
-get_ipython().run_cell_magic('writefile', 'math_entities.py', '\nfrom abc import ABC, abstractmethod\n\nclass MathEntity(ABC):\n    @abstractmethod\n    def add(self, other):\n        pass\n\n    @abstractmethod\n    def scale(self, scalar):\n        pass\n\nclass Vector(MathEntity):\n    def __init__(self, x, y, z=0):\n        self._x = x\n        self._y = y\n        self._z = z\n\n    def add(self, other):\n        return Vector(self._x + other._x, self._y + other._y, self._z + other._z)\n\n    def scale(self, scalar):\n        return Vector(self._x * scalar, self._y * scalar, self._z * scalar)\n\n    def __add__(self, other):\n        return self.add(other)\n\n    def __str__(self):\n        return f"Vector({self._x}, {self._y}, {self._z})"\n\n# ===== Matrix Class =====\nclass Matrix(MathEntity):\n    def __init__(self, rows):\n        self._rows = rows\n\n    def __add__(self, other):\n        if not isinstance(other, Matrix):\n            raise ValueError("Can only add two Matrices")\n        new_rows = []\n        for r1, r2 in zip(self._rows, other._rows):\n            new_row = [a + b for a, b in zip(r1, r2)]\n            new_rows.append(new_row)\n        return Matrix(new_rows)\n\n    def add(self, other):\n        return self + other\n\n    def scale(self, scalar):\n        new_rows = [[elem * scalar for elem in row] for row in self._rows]\n        return Matrix(new_rows)\n\n    def __mul__(self, other):\n        if not isinstance(other, Matrix):\n            raise ValueError("Can only multiply two Matrices")\n        result = []\n        for i in range(len(self._rows)):\n            row = []\n            for j in range(len(other._rows[0])):\n                val = sum(self._rows[i][k] * other._rows[k][j] for k in range(len(other._rows)))\n                row.append(val)\n            result.append(row)\n        return Matrix(result)\n\n    def __str__(self):\n        return f"Matrix({self._rows})"\n\n# ===== Utility Functions (Composition) =====\nclass MathUtils:\n    @staticmethod\n    def magnitude(vector):\n        return (vector._x**2 + vector._y**2 + vector._z**2)**0.5  # Added z for 3D magnitude\n\n    @staticmethod\n    def determinant(matrix):\n        if len(matrix._rows) != 2 or len(matrix._rows[0]) != 2:\n            raise ValueError("Only 2x2 matrices supported for determinant.")\n        a, b = matrix._rows[0]\n        c, d = matrix._rows[1]\n        return a*d - b*c\n\n# ===== Main Program =====\nif __name__ == "__main__":\n    v1 = Vector(2, 3, 1)\n    v2 = Vector(4, 1, 1)\n\n    print(v1)  # Vector(2, 3)\n    print(v2)  # Vector(4, 1)\n    print("Vector Add:", v1.add(v2))\n    print("Vector Scale (2x):", v1.scale(2))\n    print("Vector Magnitude:", MathUtils.magnitude(v1))\n\n    m1 = Matrix([[1,2], [3,4]])\n    m2 = Matrix([[5,6], [7,8]])\n\n    print(m1)  # Matrix([[1, 2], [3, 4]])\n    print(m2)  # Matrix([[5, 6], [7, 8]])\n    print("Matrix Add:", m1.add(m2))\n    print("Matrix Scale (3x):", m1.scale(3))\n    print("Matrix Determinant:", MathUtils.determinant(m1))\n')
+get_ipython().run_cell_magic('writefile', 'math_benchmarks.py', '\nimport argparse\nimport json\nimport platform\nimport random\nimport sys\nimport timeit\nfrom array import array\n\nfrom math_entities import Vector, Matrix, MathUtils\n\n# ===== Benchmark Registry =====\n# name -> (sizes, factory); factory(size) returns the zero-argument callable to time\nBENCHMARKS = {}\n\ndef benchmark(name, sizes=(1,)):\n    def register(factory):\n        BENCHMARKS[name] = (tuple(sizes), factory)\n        return factory\n    return register\n\ndef random_matrix(size, seed=0):\n    rng = random.Random(seed)\n    return Matrix([[rng.uniform(-1, 1) for _ in range(size)] for _ in range(size)])\n\n@benchmark("vector_add")\ndef bench_vector_add(size):\n    v1, v2 = Vector(1.5, 2.5, 3.5), Vector(4.0, 5.0, 6.0)\n    return lambda: v1.add(v2)\n\n@benchmark("vector_scale")\ndef bench_vector_scale(size):\n    v = Vector(1.5, 2.5, 3.5)\n    return lambda: v.scale(3.0)\n\n# the uncached cases drop the Vector\'s cached results before each call, so they keep timing\n# the math.hypot path; the *_cached cases time the cache hits\n@benchmark("magnitude")\ndef bench_magnitude(size):\n    v = Vector(1.5, 2.5, 3.5)\n\n    def run():\n        v._invalidate()\n        return MathUtils.magnitude(v)\n    return run\n\n@benchmark("magnitude_cached")\ndef bench_magnitude_cached(size):\n    v = Vector(1.5, 2.5, 3.5)\n    return lambda: MathUtils.magnitude(v)\n\n@benchmark("vector_unit")\ndef bench_vector_unit(size):\n    v = Vector(1.5, 2.5, 3.5)\n\n    def run():\n        v._invalidate()\n        return v.unit()\n    return run\n\n@benchmark("vector_unit_cached")\ndef bench_vector_unit_cached(size):\n    v = Vector(1.5, 2.5, 3.5)\n    return v.unit\n\n@benchmark("matrix_add", sizes=(10, 50, 100))\ndef bench_matrix_add(size):\n    m1, m2 = random_matrix(size, 1), random_matrix(size, 2)\n    return lambda: m1 + m2\n\n@benchmark("matrix_mul", sizes=(10, 50, 100))\ndef bench_matrix_mul(size):\n    m1, m2 = random_matrix(size, 1), random_matrix(size, 2)\n    return lambda: m1 * m2\n\n@benchmark("matrix_mul_strassen", sizes=(10, 50, 100))\ndef bench_matrix_mul_strassen(size):\n    m1, m2 = random_matrix(size, 1), random_matrix(size, 2)\n    return lambda: m1.matmul(m2, algorithm="strassen")\n\n@benchmark("determinant", sizes=(10, 50, 100))\ndef bench_determinant(size):\n    data = random_matrix(size)._data\n    # a fresh Matrix per call so the cached LU factors are not reused\n    return lambda: MathUtils.determinant(Matrix._from_buffer(array(\'d\', data), size, size))\n\n# ===== Runner =====\ndef run_benchmarks(names=None, repeat=5):\n    results = {}\n    for name in names or BENCHMARKS:\n        sizes, factory = BENCHMARKS[name]\n        for size in sizes:\n            timer = timeit.Timer(factory(size))\n            number, _ = timer.autorange()\n            times = [t / number for t in timer.repeat(repeat=repeat, number=number)]\n            results[f"{name}[{size}]"] = {"best": min(times), "mean": sum(times) / len(times), "number": number}\n    return {\n        "python": platform.python_version(),\n        "machine": platform.machine(),\n        "results": results,\n    }\n\ndef crossover(sizes=(32, 64, 96, 128, 192, 256), cutoff=None, repeat=3):\n    # times the blocked and Strassen kernels side by side; returns the rows and the\n    # first size at which Strassen is faster (None if it never wins)\n    rows = []\n    winner = None\n    for size in sizes:\n        m1, m2 = random_matrix(size, 1), random_matrix(size, 2)\n        blocked = min(timeit.repeat(lambda: m1 * m2, number=1, repeat=repeat))\n        strassen = min(timeit.repeat(lambda: m1.matmul(m2, algorithm="strassen", cutoff=cutoff),\n                                     number=1, repeat=repeat))\n        rows.append((size, blocked, strassen))\n        if winner is None and strassen < blocked:\n            winner = size\n    return rows, winner\n\ndef compare(current, baseline, tolerance=0.10):\n    # returns (key, baseline_best, current_best) for every case slower than the tolerance allows\n    regressions = []\n    for key, result in current["results"].items():\n        old = baseline["results"].get(key)\n        if old is not None and result["best"] > old["best"] * (1 + tolerance):\n            regressions.append((key, old["best"], result["best"]))\n    return regressions\n\ndef main(argv=None):\n    parser = argparse.ArgumentParser(description="Benchmark the math_entities hot paths")\n    parser.add_argument("names", nargs="*", help="benchmarks to run (default: all)")\n    parser.add_argument("--output", help="write the results as JSON to this file")\n    parser.add_argument("--baseline", help="compare against this stored JSON baseline")\n    parser.add_argument("--save-baseline", action="store_true", help="overwrite --baseline with these results")\n    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed slowdown (0.10 = 10%%)")\n    parser.add_argument("--repeat", type=int, default=5)\n    parser.add_argument("--crossover", action="store_true",\n                        help="only report where Strassen overtakes the blocked kernel")\n    parser.add_argument("--cutoff", type=int, help="Strassen cutoff used by --crossover")\n    args = parser.parse_args(argv)\n\n    if args.crossover:\n        rows, winner = crossover(cutoff=args.cutoff)\n        for size, blocked, strassen in rows:\n            print(f"{size:5d}  blocked {blocked * 1e3:10.2f} ms  strassen {strassen * 1e3:10.2f} ms")\n        print(f"Strassen wins from n = {winner}" if winner else "Strassen never won")\n        return 0\n\n    unknown = set(args.names) - set(BENCHMARKS)\n    if unknown:\n        parser.error(f"unknown benchmarks: {\', \'.join(sorted(unknown))}")\n    current = run_benchmarks(args.names, repeat=args.repeat)\n    for key, result in current["results"].items():\n        print(f"{key:24s} {result[\'best\'] * 1e6:12.2f} us")\n    if args.output:\n        with open(args.output, "w") as f:\n            json.dump(current, f, indent=2)\n\n    if args.baseline and args.save_baseline:\n        with open(args.baseline, "w") as f:\n            json.dump(current, f, indent=2)\n    elif args.baseline:\n        with open(args.baseline) as f:\n            baseline = json.load(f)\n        regressions = compare(current, baseline, args.tolerance)\n        for key, old, new in regressions:\n            print(f"REGRESSION {key}: {old * 1e6:.2f} us -> {new * 1e6:.2f} us ({new / old - 1:+.0%})")\n        if regressions:\n            return 1\n    return 0\n\nif __name__ == "__main__":\n    sys.exit(main())\n')
 
 
-# In[66]:
+# In[ ]:
 
 
 import unittest
 import importlib
+import os
+import sys
+import tempfile
+from array import array
+from unittest.mock import patch
 import math_entities
 importlib.reload(math_entities)  # Force reloading the updated file!
-from math_entities import Vector, Matrix
+from math_entities import Vector, VectorBatch, Matrix, SparseMatrix, LazyExpr, MathUtils
 
 # ===== Unit Tests =====
 class TestVector(unittest.TestCase):
@@ -1359,11 +3841,404 @@ class TestVector(unittest.TestCase):
         v3 = v1 + v2
         self.assertEqual((v3._x, v3._y, v3._z), (4, 6, 2))  # fixed: include z also!
 
+    def test_in_place_operators(self):
+        acc = Vector(0, 0, 0)
+        same = acc
+        for _ in range(3):
+            acc += Vector(1, 2, 3)
+        acc *= 2
+        self.assertIs(acc, same)
+        self.assertEqual((acc._x, acc._y, acc._z), (6, 12, 18))
+
+    def test_magnitude_is_cached_and_invalidated(self):
+        v = Vector(3, 4, 0)
+        self.assertEqual(MathUtils.magnitude(v), 5.0)
+        self.assertEqual(v._magnitude, 5.0)
+        v += Vector(0, 0, 12)
+        self.assertIsNone(v._magnitude)
+        self.assertEqual(MathUtils.magnitude(v), 13.0)
+        v *= 2
+        self.assertEqual(MathUtils.magnitude(v), 26.0)
+
+    def test_unit(self):
+        v = Vector(3, 4, 0)
+        u = v.unit()
+        self.assertEqual((u._x, u._y, u._z), (0.6, 0.8, 0.0))
+        u *= 10  # mutating the result must not touch v's cache
+        self.assertEqual(v.unit()._x, 0.6)
+        with self.assertRaises(ValueError):
+            Vector(0, 0, 0).unit()
+
+    def test_no_instance_dict(self):
+        self.assertFalse(hasattr(Vector(1, 2), "__dict__"))
+        self.assertFalse(hasattr(Matrix([[1]]), "__dict__"))
+
+class TestVectorBatch(unittest.TestCase):
+    def setUp(self):
+        self.vectors = [Vector(1, 2, 2), Vector(3, 4, 0), Vector(0, 0, 5)]
+        self.batch = VectorBatch.from_vectors(self.vectors)
+
+    def test_round_trip(self):
+        back = self.batch.to_vectors()
+        self.assertEqual([(v._x, v._y, v._z) for v in back], [(1, 2, 2), (3, 4, 0), (0, 0, 5)])
+
+    def test_add_and_scale_match_vector(self):
+        result = (self.batch + self.batch).scale(0.5)
+        for got, v in zip(result.to_vectors(), self.vectors):
+            self.assertEqual((got._x, got._y, got._z), (v._x, v._y, v._z))
+
+    def test_magnitude_dot_and_normalize(self):
+        self.assertEqual(MathUtils.magnitude(self.batch).tolist(), [3.0, 5.0, 5.0])
+        self.assertEqual(self.batch.dot(self.batch).tolist(), [9.0, 25.0, 25.0])
+        for m in MathUtils.magnitude(self.batch.normalize()):
+            self.assertAlmostEqual(m, 1.0)
+
+    def test_length_mismatch_raises(self):
+        shorter = VectorBatch.from_vectors(self.vectors[:2])
+        with self.assertRaises(ValueError):
+            self.batch.dot(shorter)
+        with self.assertRaises(ValueError):
+            self.batch + shorter
+
+class TestMatrix(unittest.TestCase):
+    def naive_product(self, a, b):
+        return [[sum(a[i][k] * b[k][j] for k in range(len(b))) for j in range(len(b[0]))]
+                for i in range(len(a))]
+
+    def test_multiplication(self):
+        m1 = Matrix([[1, 2], [3, 4]])
+        m2 = Matrix([[5, 6], [7, 8]])
+        self.assertEqual((m1 * m2).tolist(), [[19, 22], [43, 50]])
+
+    def test_blocked_multiplication_matches_naive(self):
+        a = [[(i * 7 + j * 3) % 11 - 5 for j in range(13)] for i in range(9)]
+        b = [[(i * 5 + j * 2) % 7 - 3 for j in range(6)] for i in range(13)]
+        m1, m2 = Matrix(a), Matrix(b)
+        with patch.object(Matrix, "BLOCK_SIZE", 4):  # force several partial tiles
+            self.assertEqual((m1 * m2).tolist(), self.naive_product(a, b))
+            self.assertEqual((m1 * m2).shape, (9, 6))
+
+    def test_in_place_operators(self):
+        m = Matrix([[1, 2], [3, 4]])
+        data = m._data
+        m += Matrix([[1, 1], [1, 1]])
+        m *= 2
+        self.assertIs(m._data, data)
+        self.assertEqual(m.tolist(), [[4, 6], [8, 10]])
+        m *= Matrix([[1], [1]])
+        self.assertEqual(m.tolist(), [[10], [18]])
+
+    def test_in_place_invalidates_lu_cache(self):
+        m = Matrix([[2, 0], [0, 2]])
+        MathUtils.solve(m, [2, 2])
+        m *= 2
+        self.assertEqual(MathUtils.solve(m, [4, 4]), [1.0, 1.0])
+
+    def test_strassen_matches_blocked(self):
+        for n, m, p in ((5, 5, 5), (16, 16, 16), (9, 13, 6), (1, 3, 1)):
+            a = Matrix([[(i * 7 + j * 3) % 11 - 5 for j in range(m)] for i in range(n)])
+            b = Matrix([[(i * 5 + j * 2) % 7 - 3 for j in range(p)] for i in range(m)])
+            product = a.matmul(b, algorithm="strassen", cutoff=2)
+            self.assertEqual(product.shape, (n, p))
+            self.assertEqual(product.tolist(), (a * b).tolist())
+
+    def test_strassen_skips_skinny_operands_and_honours_cutoff(self):
+        with patch.object(math_entities, "_strassen_rows", wraps=math_entities._strassen_rows) as spy:
+            row, col = Matrix([[1.0] * 400]), Matrix([[1.0]] * 400)
+            self.assertEqual(row.matmul(col, algorithm="strassen").tolist(), [[400.0]])
+            self.assertEqual(spy.call_count, 0)
+            square = Matrix([[1, 2, 3, 4]] * 4)
+            square.matmul(square, algorithm="strassen", cutoff=0)
+            self.assertEqual(spy.call_count, 1 + 7 + 49)  # cutoff 0 recurses down to 1x1
+
+    def test_unknown_algorithm(self):
+        with self.assertRaises(ValueError):
+            Matrix([[1]]).matmul(Matrix([[1]]), algorithm="winograd")
+
+    def test_parallel_matches_serial(self):
+        a = Matrix([[(i * 7 + j * 3) % 11 - 5 for j in range(13)] for i in range(9)])
+        b = Matrix([[(i * 5 + j * 2) % 7 - 3 for j in range(6)] for i in range(13)])
+        product = a.matmul(b, algorithm="parallel", workers=2, threshold=0)
+        self.assertEqual(product.tolist(), (a * b).tolist())
+
+    def test_parallel_small_input_stays_serial(self):
+        a = Matrix([[1, 2], [3, 4]])
+        with patch("math_parallel.ProcessPoolExecutor") as pool:
+            self.assertEqual(a.matmul(a, algorithm="parallel").tolist(), [[7, 10], [15, 22]])
+        pool.assert_not_called()
+
+    def test_dimension_mismatch(self):
+        with self.assertRaises(ValueError):
+            Matrix([[1, 2, 3]]) * Matrix([[1, 2, 3]])
+
+class TestMatrixPersistence(unittest.TestCase):
+    def setUp(self):
+        self.m = Matrix([[1, 2, 3], [4, 5, 6]])
+        handle, self.path = tempfile.mkstemp(suffix=".mtrx")
+        os.close(handle)
+        self.m.save(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_frombuffer_is_zero_copy(self):
+        data = array('d', [1, 2, 3, 4])
+        m = Matrix.frombuffer(data, 2, 2)
+        data[0] = 10
+        self.assertEqual(m.tolist(), [[10, 2], [3, 4]])
+        with self.assertRaises(ValueError):
+            Matrix.frombuffer(data, 3, 3)
+
+    def test_frombuffer_sees_later_writes_in_solves(self):
+        data = array('d', [1, 0, 0, 0, 1, 0, 0, 0, 1])
+        m = Matrix.frombuffer(data, 3, 3)
+        self.assertEqual(MathUtils.determinant(m), 1.0)
+        data[0] = 5
+        self.assertEqual(MathUtils.determinant(m), 5.0)
+
+    def test_memoryview_method(self):
+        view = self.m.memoryview()
+        self.assertEqual(view.shape, (2, 3))
+        self.assertEqual(view.tolist(), self.m.tolist())
+
+    @unittest.skipUnless(sys.version_info >= (3, 12), "__buffer__ needs Python 3.12")
+    def test_memoryview(self):
+        view = memoryview(self.m)
+        self.assertEqual(view.shape, (2, 3))
+        self.assertEqual(view.tolist(), self.m.tolist())
+
+    def test_open_mmap_copy_on_write_of_a_read_only_file(self):
+        os.chmod(self.path, 0o444)
+        mapped = Matrix.open_mmap(self.path, mode="c")
+        mapped *= 2
+        self.assertEqual(mapped.tolist(), [[2, 4, 6], [8, 10, 12]])
+        self.assertEqual(Matrix.open_mmap(self.path).tolist(), self.m.tolist())
+
+    def test_open_mmap_round_trip(self):
+        mapped = Matrix.open_mmap(self.path)
+        self.assertEqual(mapped.shape, (2, 3))
+        self.assertEqual(mapped.tolist(), self.m.tolist())
+        self.assertEqual((mapped * Matrix([[1], [1], [1]])).tolist(), [[6], [15]])
+        with self.assertRaises(TypeError):
+            mapped += mapped  # read-only mapping
+
+    def test_open_mmap_write_through(self):
+        mapped = Matrix.open_mmap(self.path, mode="r+")
+        mapped *= 2
+        del mapped
+        self.assertEqual(Matrix.open_mmap(self.path).tolist(), [[2, 4, 6], [8, 10, 12]])
+
+    def test_rejects_other_files(self):
+        with open(self.path, "wb") as f:
+            f.write(b"not a matrix file at all")
+        with self.assertRaises(ValueError):
+            Matrix.open_mmap(self.path)
+
+class TestLinearAlgebra(unittest.TestCase):
+    def setUp(self):
+        self.m = Matrix([[2, 1, 1], [4, -6, 0], [-2, 7, 2]])
+
+    def test_determinant(self):
+        self.assertEqual(MathUtils.determinant(Matrix([[1, 2], [3, 4]])), -2)
+        self.assertAlmostEqual(MathUtils.determinant(self.m), -16)
+        self.assertEqual(MathUtils.determinant(Matrix([[1, 2, 3], [2, 4, 6], [1, 0, 1]])), 0.0)
+
+    def test_solve(self):
+        x = MathUtils.solve(self.m, [5, -2, 9])
+        for got, expected in zip(x, [1, 1, 2]):
+            self.assertAlmostEqual(got, expected)
+
+    def test_factorization_is_cached(self):
+        factors = self.m._lu_factors()
+        MathUtils.solve(self.m, [1, 0, 0])
+        MathUtils.solve(self.m, [0, 1, 0])
+        self.assertIs(self.m._lu_factors(), factors)
+
+    def test_inverse(self):
+        product = self.m * MathUtils.inverse(self.m)
+        for i, row in enumerate(product.tolist()):
+            for j, value in enumerate(row):
+                self.assertAlmostEqual(value, 1.0 if i == j else 0.0)
+
+    def test_singular(self):
+        singular = Matrix([[1, 2, 3], [2, 4, 6], [1, 0, 1]])
+        with self.assertRaises(ValueError):
+            MathUtils.solve(singular, [1, 2, 3])
+        with self.assertRaises(ValueError):
+            MathUtils.inverse(Matrix([[1, 2, 3]]))
+
+class TestSparseMatrix(unittest.TestCase):
+    def setUp(self):
+        self.dense = [[1, 0, 0, 2], [0, 0, 3, 0], [0, 0, 0, 0], [4, 0, 5, 0]]
+        self.sparse = SparseMatrix.from_matrix(Matrix(self.dense))
+
+    def test_round_trip(self):
+        self.assertEqual(self.sparse.nnz, 5)
+        self.assertEqual(self.sparse.to_matrix().tolist(), self.dense)
+
+    def test_coo_duplicates_are_summed(self):
+        s = SparseMatrix(2, 2, [(0, 1, 1.5), (0, 1, 1.5), (1, 0, 2), (1, 0, -2)])
+        self.assertEqual(s.nnz, 1)
+        self.assertEqual(s.to_matrix().tolist(), [[0, 3], [0, 0]])
+
+    def test_add_and_scale(self):
+        total = (self.sparse + self.sparse.scale(-1)).scale(3)
+        self.assertEqual(total.nnz, 0)
+        doubled = self.sparse + self.sparse
+        self.assertEqual(doubled.to_matrix().tolist(), (Matrix(self.dense).scale(2)).tolist())
+
+    def test_products_match_dense(self):
+        m = Matrix(self.dense)
+        expected = (m * m).tolist()
+        self.assertEqual((self.sparse * m).tolist(), expected)
+        self.assertEqual((self.sparse * self.sparse).to_matrix().tolist(), expected)
+
+class TestLazyExpr(unittest.TestCase):
+    def setUp(self):
+        self.m1 = Matrix([[1, 2], [3, 4]])
+        self.m2 = Matrix([[5, 6], [7, 8]])
+        self.m3 = Matrix([[1, 0], [2, 1]])
+
+    def test_matches_eager_evaluation(self):
+        eager = (self.m1 + self.m2).scale(3) * self.m3
+        expr = (self.m1.lazy() + self.m2).scale(3) * self.m3
+        self.assertIsInstance(expr, LazyExpr)
+        self.assertEqual(expr.evaluate().tolist(), eager.tolist())
+
+    def test_elementwise_chain_is_fused(self):
+        expr = (self.m1.lazy() + self.m2.scale(2)).scale(0.5) + self.m1 + self.m3.lazy().scale(-1)
+        terms = {}
+        expr._linear_terms(1, terms)
+        self.assertEqual(len(terms), 3)  # m1 appears once with its coefficients merged
+        eager = (self.m1 + self.m2.scale(2)).scale(0.5) + self.m1 + self.m3.scale(-1)
+        self.assertEqual(expr.evaluate().tolist(), eager.tolist())
+
+    def test_matrix_on_the_left_stays_lazy(self):
+        self.assertIsInstance(self.m1 + self.m2.lazy(), LazyExpr)
+        self.assertIsInstance(self.m1 * self.m2.lazy(), LazyExpr)
+        self.assertEqual((self.m1 + self.m2.lazy()).evaluate().tolist(), (self.m1 + self.m2).tolist())
+        self.assertEqual((self.m1 * self.m2.lazy()).evaluate().tolist(), (self.m1 * self.m2).tolist())
+
+    def test_long_chains_do_not_recurse(self):
+        acc = self.m1.lazy()
+        for _ in range(3000):
+            acc = acc + self.m3
+        self.assertEqual(acc.evaluate().tolist(), [[3001, 2], [6003, 3004]])
+        product = Matrix([[1, 0], [0, 1]]).lazy()
+        for _ in range(3000):
+            product = product * self.m3.lazy().scale(1)
+        self.assertEqual(product.evaluate().tolist(), [[1, 0], [6000, 1]])
+
+    def test_evaluate_reads_current_values(self):
+        expr = self.m1.lazy() + self.m2
+        self.assertEqual(expr.evaluate().tolist(), [[6, 8], [10, 12]])
+        self.m1 += self.m1
+        self.assertEqual(expr.evaluate().tolist(), [[7, 10], [13, 16]])
+
+    def test_non_matrix_operands_fall_back(self):
+        v = (Vector(1, 2, 3).lazy() + Vector(1, 1, 1)).scale(2).evaluate()
+        self.assertEqual((v._x, v._y, v._z), (4, 6, 8))
+
+class TestBenchmarks(unittest.TestCase):
+    def test_run_and_compare(self):
+        import math_benchmarks
+        current = math_benchmarks.run_benchmarks(["vector_add"], repeat=1)
+        self.assertIn("vector_add[1]", current["results"])
+        baseline = {"results": {"vector_add[1]": {"best": current["results"]["vector_add[1]"]["best"] / 2}}}
+        self.assertEqual(len(math_benchmarks.compare(current, baseline)), 1)
+        self.assertEqual(math_benchmarks.compare(current, current), [])
+
+class TestPasswords(unittest.TestCase):
+    def test_hash_and_verify(self):
+        from passwords import hash_password, verify_password
+        for algorithm, params in (("scrypt", {"n": 2 ** 8}), ("pbkdf2_sha256", {"iterations": 1_000})):
+            encoded = hash_password("s3cret", algorithm, **params)
+            self.assertTrue(encoded.startswith(algorithm + "$"))
+            self.assertTrue(verify_password("s3cret", encoded))
+            self.assertFalse(verify_password("S3cret", encoded))
+        self.assertNotEqual(hash_password("s3cret", n=2 ** 8), hash_password("s3cret", n=2 ** 8))  # salted
+        with self.assertRaises(ValueError):
+            verify_password("s3cret", "md5$abc")
+
+    def test_ttl_cache(self):
+        from passwords import TTLCache
+        now = [0.0]
+        cache = TTLCache(maxsize=2, ttl=10, clock=lambda: now[0])
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)  # evicts "b", the least recently used
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), (1, None, 3))
+        now[0] = 10
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 1)
+
+    def test_hasher_apis(self):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        from passwords import PasswordHasher
+        with ThreadPoolExecutor(2) as executor, PasswordHasher(executor=executor, n=2 ** 8) as hasher:
+            first, second = hasher.hash_many(["alpha", "beta"])
+            self.assertEqual(hasher.verify_many([("alpha", first), ("alpha", second)]), [True, False])
+            self.assertTrue(hasher.verify("alpha", first))  # served from the cache
+            self.assertEqual(hasher.stats, {"hits": 1, "misses": 2})
+
+            async def login_storm():
+                encoded = await hasher.hash_async("gamma")
+                return await asyncio.gather(*(hasher.verify_async("gamma", encoded) for _ in range(5)))
+            self.assertEqual(asyncio.run(login_storm()), [True] * 5)
+            self.assertEqual(hasher.stats["misses"], 7)
+
+    def test_process_pool(self):
+        from passwords import PasswordHasher, verify_password
+        with PasswordHasher(workers=2, n=2 ** 8) as hasher:
+            hashes = hasher.hash_many(["a", "b", "c"])
+        self.assertTrue(all(verify_password(p, h) for p, h in zip("abc", hashes)))
+
 if __name__ == "__main__":
     unittest.main(argv=['first-arg-is-ignored'], exit=False)
 
 
 
+# In[ ]:
+
+
+# Memory benchmark: bytes per instance before and after __slots__
+import tracemalloc
+from math_entities import Vector, Matrix
+
+# the previous layouts, kept here only for comparison
+class DictVector:
+    def __init__(self, x, y, z=0):
+        self._x = x
+        self._y = y
+        self._z = z
+
+class NestedListMatrix:
+    def __init__(self, rows):
+        self._rows = rows
+
+def bytes_per_instance(factory, n=100_000):
+    objects = [None] * n  # allocated up front so only the instances are measured
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(n):
+        objects[i] = factory()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / n
+
+rows = [[float(i * 4 + j) for j in range(4)] for i in range(4)]
+results = {
+    "Vector (__dict__)": bytes_per_instance(lambda: DictVector(1.0, 2.0, 3.0)),
+    "Vector (__slots__)": bytes_per_instance(lambda: Vector(1.0, 2.0, 3.0)),
+    "4x4 Matrix (nested lists)": bytes_per_instance(lambda: NestedListMatrix([list(r) for r in rows]), n=20_000),
+    "4x4 Matrix (__slots__ + array)": bytes_per_instance(lambda: Matrix(rows), n=20_000),
+}
+for name, size in results.items():
+    print(f"{name:32s} {size:8.1f} bytes/instance")
+
+
 # ### Vector and Matrix Operations Library
 # 
 # A Python library implementing core vector and matrix operations using Object-Oriented Programming (OOP) principles.